@@ -0,0 +1,109 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import sys
+import tempfile
+import time
+
+from .stub_ollama import StubOllama
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench", description="Offline ingest and query benchmark")
+    parser.add_argument("--docs", type=int, default=200, help="documents per provider")
+    parser.add_argument("--providers", type=int, default=2)
+    parser.add_argument("--sections", type=int, default=4)
+    parser.add_argument("--paragraphs", type=int, default=3)
+    parser.add_argument("--fetch-latency", type=float, default=0.0, help="seconds per fetch_content call")
+    parser.add_argument("--dim", type=int, default=256)
+    parser.add_argument("--embed-latency", type=float, default=0.005)
+    parser.add_argument("--embed-latency-per-input", type=float, default=0.001)
+    parser.add_argument("--first-token-latency", type=float, default=0.05)
+    parser.add_argument("--token-latency", type=float, default=0.01)
+    parser.add_argument("--answer-tokens", type=int, default=32)
+    parser.add_argument("--concurrency", default="1,4,16", help="comma-separated query concurrency levels")
+    parser.add_argument("--queries", type=int, default=64, help="queries per concurrency level")
+    parser.add_argument("--qdrant-url", default=":memory:", help="a real Qdrant URL, or :memory:")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--out", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    stub = StubOllama(
+        dim=args.dim,
+        embed_latency=args.embed_latency,
+        embed_latency_per_input=args.embed_latency_per_input,
+        first_token_latency=args.first_token_latency,
+        token_latency=args.token_latency,
+        answer_tokens=args.answer_tokens,
+    ).start()
+    state_dir = tempfile.mkdtemp(prefix="bench-state-")
+    collection = f"bench_{int(time.time())}"
+    # chat.* reads these at import time, so they are set before the first chat import
+    os.environ.update(
+        {
+            "STATE_PATH": os.path.join(state_dir, "state.json"),
+            "OLLAMA_URL": stub.url,
+            "QDRANT_URL": args.qdrant_url,
+            "QDRANT_COLLECTION": collection,
+        }
+    )
+    if args.qdrant_url == ":memory:":
+        # local mode is not thread-safe; keep Qdrant writes on one thread
+        os.environ["QDRANT_UPSERT_PARALLELISM"] = "1"
+
+    from chat.settings import settings
+
+    from .providers import SyntheticProvider
+    from .run import bench_ingest, bench_query
+
+    providers = [
+        SyntheticProvider(
+            f"bench{i}",
+            args.docs,
+            sections=args.sections,
+            paragraphs=args.paragraphs,
+            seed=args.seed + i,
+            fetch_latency=args.fetch_latency,
+        )
+        for i in range(args.providers)
+    ]
+    try:
+        ingest = bench_ingest(stub, providers)
+        levels = [int(c) for c in args.concurrency.split(",") if c]
+        query = asyncio.run(bench_query(stub, levels, args.queries, args.seed))
+    finally:
+        stub.stop()
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "args": vars(args),
+        "settings": {
+            k: getattr(settings, k)
+            for k in (
+                "chunk_mode",
+                "chunk_max_tokens",
+                "embed_batch_size",
+                "embed_concurrency",
+                "qdrant_upsert_batch_size",
+                "qdrant_upsert_parallelism",
+                "hybrid_search",
+                "rerank_mode",
+                "top_k",
+            )
+        },
+        "ingest": ingest,
+        "query": query,
+    }
+    text = json.dumps(report, indent=2)
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import argparse
+import json
+import random
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List
+
+from chat.ingest import extract
+from chat.ingest.storage_format import to_markdown
+
+from .providers import WORDS
+
+try:
+    from bs4 import BeautifulSoup
+except ImportError:  # the baseline is skipped without it
+    BeautifulSoup = None
+
+HEADINGS = ["h1", "h2", "h3", "h4", "h5", "h6"]
+
+
+def soup_text(html: str) -> str:
+    # what ConfluenceProvider.parse did before the storage-format converter
+    soup = BeautifulSoup(html, "html.parser")
+    for h in soup.find_all(HEADINGS):
+        h.string = f"{'#' * int(h.name[1])} {h.get_text(' ', strip=True)}"
+    return soup.get_text("\n", strip=True)
+
+
+def _sentence(rng: random.Random) -> str:
+    return " ".join(rng.choices(WORDS, k=rng.randint(8, 18))).capitalize() + "."
+
+
+def page(i: int, sections: int = 6, seed: int = 0) -> str:
+    # a storage-format page with the usual mix: macros, panels, lists, tables, code and links
+    rng = random.Random(seed * 1_000_003 + i)
+    out = ['<ac:structured-macro ac:name="toc"><ac:parameter ac:name="maxLevel">3</ac:parameter></ac:structured-macro>']
+    for s in range(sections):
+        out.append(f"<h2>Section {s} of page {i}</h2>")
+        for _ in range(rng.randint(2, 4)):
+            out.append(f"<p>{' '.join(_sentence(rng) for _ in range(rng.randint(2, 5)))} <strong>PROJ-{i}</strong></p>")
+        out.append("<ul>" + "".join(f"<li><p>{_sentence(rng)}</p></li>" for _ in range(rng.randint(2, 6))) + "</ul>")
+        rows = "".join(
+            f"<tr><td><p>{rng.choice(WORDS)}</p></td><td>{rng.randint(1, 999)}</td><td>{_sentence(rng)}</td></tr>"
+            for _ in range(rng.randint(3, 10))
+        )
+        out.append(f"<table><tbody><tr><th>Name</th><th>Count</th><th>Notes</th></tr>{rows}</tbody></table>")
+        out.append(
+            '<ac:structured-macro ac:name="code"><ac:parameter ac:name="language">bash</ac:parameter>'
+            f"<ac:plain-text-body><![CDATA[{rng.choice(WORDS)} --{rng.choice(WORDS)}=1\n"
+            f"{rng.choice(WORDS)} | grep {rng.choice(WORDS)}]]></ac:plain-text-body></ac:structured-macro>"
+        )
+        out.append(
+            '<ac:structured-macro ac:name="info"><ac:parameter ac:name="title">Note</ac:parameter>'
+            f'<ac:rich-text-body><p>{_sentence(rng)} See <ac:link><ri:page ri:content-title="Runbook {s}" />'
+            "</ac:link>.</p></ac:rich-text-body></ac:structured-macro>"
+        )
+    return "".join(out)
+
+
+def _time(fn: Callable[[str], str], pages: List[str], rounds: int) -> Dict[str, float]:
+    per_page = []
+    for _ in range(rounds):
+        for html in pages:
+            t0 = time.perf_counter()
+            fn(html)
+            per_page.append(time.perf_counter() - t0)
+    return {
+        "mean_us": round(statistics.fmean(per_page) * 1e6, 1),
+        "p50_us": round(statistics.median(per_page) * 1e6, 1),
+        "pages_per_sec": round(len(per_page) / sum(per_page), 1),
+    }
+
+
+def _threaded(fn: Callable[[str], str], pages: List[str], threads: int) -> float:
+    # pages/sec with `threads` callers, as the pipeline's chunk stage drives parse()
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        list(pool.map(fn, pages))
+    return round(len(pages) / (time.perf_counter() - start), 1)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m bench.confluence", description="Confluence page conversion")
+    parser.add_argument("--pages", type=int, default=200)
+    parser.add_argument("--sections", type=int, default=6)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=4, help="concurrent callers for the throughput numbers")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    pages = [page(i, args.sections, args.seed) for i in range(args.pages)]
+    report = {
+        "pages": args.pages,
+        "mean_page_chars": round(statistics.fmean(len(p) for p in pages)),
+        "storage_format": _time(to_markdown, pages, args.rounds),
+    }
+    if BeautifulSoup is not None:
+        report["beautifulsoup"] = _time(soup_text, pages, args.rounds)
+        report["speedup"] = round(report["beautifulsoup"]["mean_us"] / report["storage_format"]["mean_us"], 2)
+    try:
+        # warm the worker processes so their start-up is not counted
+        list(extract._get_pool().map(to_markdown, pages[: extract.settings.extract_workers]))
+        report["threaded_pages_per_sec"] = {
+            "inline": _threaded(to_markdown, pages, args.threads),
+            "pool": _threaded(extract.storage_to_text, pages, args.threads),
+        }
+    finally:
+        extract._reset_pool()
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,71 @@
+import random
+import time
+from typing import Iterable, Optional
+
+from chat.ingest.providers.base import DocContent, DocItem, Provider
+
+WORDS = (
+    "service deploy cluster token request latency cache index query config backup release customer invoice "
+    "account policy incident network storage pipeline schema migration endpoint gateway worker queue retry "
+    "timeout certificate rollout dashboard alert budget onboarding runbook approval vendor contract"
+).split()
+
+
+class SyntheticProvider(Provider):
+    # Deterministic fake corpus: document i always has the same text for a given seed and revision, so re-runs
+    # exercise the unchanged-document path and bumping `revision` exercises re-ingestion.
+    def __init__(
+        self,
+        name: str,
+        docs: int,
+        sections: int = 4,
+        paragraphs: int = 3,
+        seed: int = 0,
+        revision: int = 1,
+        fetch_latency: float = 0.0,
+    ):
+        self.name = name
+        self.docs = docs
+        self.sections = sections
+        self.paragraphs = paragraphs
+        self.seed = seed
+        self.revision = revision
+        self.fetch_latency = fetch_latency
+        self.cursor = None
+
+    def _item(self, i: int) -> DocItem:
+        return DocItem(
+            doc_id=f"{self.name}-{i}",
+            title=f"{self.name.title()} document {i}",
+            mime_type="text/markdown",
+            modified_at=f"2024-01-01T00:00:{self.revision:02d}Z",
+            parents=[],
+            web_url=f"https://bench.local/{self.name}/{i}",
+            source=self.name,
+        )
+
+    def text(self, i: int) -> str:
+        rng = random.Random(self.seed * 1_000_003 + i)
+        out = []
+        for s in range(self.sections):
+            out.append(f"# Section {s} of document {i}\n")
+            for _ in range(self.paragraphs):
+                sentences = []
+                for _ in range(rng.randint(3, 6)):
+                    words = rng.choices(WORDS, k=rng.randint(8, 18))
+                    if rng.random() < 0.2:
+                        words.append(f"PROJ-{rng.randint(1000, 9999)}")
+                    sentences.append(" ".join(words).capitalize() + ".")
+                out.append(" ".join(sentences) + "\n\n")
+        return "".join(out)
+
+    def list_changed(self, since: Optional[str]) -> Iterable:
+        for i in range(self.docs):
+            yield {"item": self._item(i)}
+        self.cursor = f"bench-{self.revision}"
+        yield "__cursor__"
+
+    def fetch_content(self, item: DocItem) -> DocContent:
+        if self.fetch_latency:
+            time.sleep(self.fetch_latency)
+        return DocContent(text=self.text(int(item.doc_id.rsplit("-", 1)[1])), html=None, version=item.modified_at)
@@ -0,0 +1,139 @@
+import asyncio
+import random
+import time
+from typing import Any, Dict, List
+
+import httpx
+import numpy as np
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import PointStruct
+
+from chat.ingest import qdrant_ops
+from chat.ingest.orchestrator import run_provider
+from chat.ingest.store import EmbeddingCache
+from chat.settings import settings
+from chat.views.rag_api import QueryIn, RagAPI
+
+from .providers import WORDS, SyntheticProvider
+from .stub_ollama import StubOllama
+
+
+def _ingest_pass(providers: List[SyntheticProvider]) -> Dict[str, Any]:
+    cache = EmbeddingCache()
+    totals = {"changed": 0, "unchanged": 0, "deleted": 0, "failed": 0, "errors": 0}
+    start = time.perf_counter()
+    try:
+        # one provider at a time: the in-memory Qdrant client is not thread-safe across writers
+        for p in providers:
+            for key, n in run_provider(p, cache).items():
+                totals[key] += n
+    finally:
+        cache.close()
+    return {"seconds": time.perf_counter() - start, "documents": totals}
+
+
+def bench_ingest(stub: StubOllama, providers: List[SyntheticProvider]) -> Dict[str, Any]:
+    qdrant_ops.ensure_collection()
+    stub.reset_counts()
+    first = _ingest_pass(providers)
+    embed = dict(stub.counts)
+    points = qdrant_ops.qdrant.count(qdrant_ops.COLLECTION, exact=True).count
+    docs = sum(p.docs for p in providers)
+    # the same corpus again: every document should be skipped through the manifest
+    stub.reset_counts()
+    again = _ingest_pass(providers)
+    return {
+        "documents": docs,
+        "chunks": points,
+        "seconds": round(first["seconds"], 3),
+        "docs_per_sec": round(docs / first["seconds"], 2),
+        "chunks_per_sec": round(points / first["seconds"], 2),
+        "embed_calls": embed["embed_calls"],
+        "embed_calls_per_doc": round(embed["embed_calls"] / docs, 3) if docs else 0.0,
+        "embed_inputs_per_doc": round(embed["embed_inputs"] / docs, 3) if docs else 0.0,
+        "errors": first["documents"]["errors"],
+        "unchanged_rerun": {
+            "seconds": round(again["seconds"], 3),
+            "skipped": again["documents"]["unchanged"],
+            "embed_calls": stub.counts["embed_calls"],
+        },
+    }
+
+
+async def _mirror_collection(target: AsyncQdrantClient):
+    # the ingest (sync) and query (async) in-memory clients are separate databases; copy the points across
+    info = qdrant_ops.qdrant.get_collection(qdrant_ops.COLLECTION)
+    await target.create_collection(
+        qdrant_ops.COLLECTION,
+        vectors_config=info.config.params.vectors,
+        sparse_vectors_config=info.config.params.sparse_vectors,
+    )
+    offset = None
+    while True:
+        points, offset = qdrant_ops.qdrant.scroll(
+            qdrant_ops.COLLECTION, limit=512, offset=offset, with_payload=True, with_vectors=True
+        )
+        if points:
+            await target.upsert(
+                qdrant_ops.COLLECTION,
+                points=[PointStruct(id=p.id, vector=p.vector, payload=p.payload) for p in points],
+            )
+        if offset is None:
+            break
+
+
+def _queries(n: int, seed: int) -> List[str]:
+    rng = random.Random(seed)
+    out = []
+    for i in range(n):
+        words = rng.sample(WORDS, rng.randint(3, 7))
+        if rng.random() < 0.2:
+            words.append(f"PROJ-{rng.randint(1000, 9999)}")
+        out.append(f"how do I {' '.join(words)} ({i})")
+    return out
+
+
+async def _run_level(api: RagAPI, ollama, qdrant, queries: List[str], concurrency: int) -> Dict[str, Any]:
+    sem = asyncio.Semaphore(concurrency)
+    latencies: List[float] = []
+
+    async def one(q):
+        async with sem:
+            t0 = time.perf_counter()
+            await api._answer(ollama, qdrant, QueryIn(query=q))
+            latencies.append(time.perf_counter() - t0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(one(q) for q in queries))
+    wall = time.perf_counter() - start
+    p50, p95, p99 = np.percentile(latencies, [50, 95, 99]) * 1000
+    return {
+        "concurrency": concurrency,
+        "queries": len(queries),
+        "qps": round(len(queries) / wall, 2),
+        "p50_ms": round(float(p50), 1),
+        "p95_ms": round(float(p95), 1),
+        "p99_ms": round(float(p99), 1),
+    }
+
+
+async def bench_query(stub: StubOllama, levels: List[int], per_level: int, seed: int) -> List[Dict[str, Any]]:
+    qdrant = AsyncQdrantClient(location=settings.qdrant_url)
+    if settings.qdrant_url == ":memory:":
+        await _mirror_collection(qdrant)
+    ollama = httpx.AsyncClient(
+        base_url=stub.url,
+        timeout=60.0,
+        limits=httpx.Limits(max_connections=settings.ollama_max_connections),
+    )
+    api = RagAPI()
+    results = []
+    try:
+        for n, level in enumerate(levels):
+            # fresh queries per level so the answer cache does not turn later levels into cache hits
+            queries = _queries(per_level, seed + n)
+            results.append(await _run_level(api, ollama, qdrant, queries, level))
+    finally:
+        await ollama.aclose()
+        await qdrant.close()
+    return results
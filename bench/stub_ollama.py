@@ -0,0 +1,113 @@
+import hashlib
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+
+def embedding(text: str, dim: int):
+    # deterministic unit vector per text, so identical chunks embed identically across runs
+    seed = int.from_bytes(hashlib.sha1(text.encode("utf-8")).digest()[:8], "little")
+    v = np.random.default_rng(seed).standard_normal(dim).astype(np.float32)
+    return (v / np.linalg.norm(v)).tolist()
+
+
+class StubOllama:
+    # Minimal /api/embed and /api/generate with configurable latency, counting the calls it serves.
+    def __init__(
+        self,
+        dim: int = 256,
+        embed_latency: float = 0.005,
+        embed_latency_per_input: float = 0.001,
+        first_token_latency: float = 0.05,
+        token_latency: float = 0.01,
+        answer_tokens: int = 32,
+    ):
+        self.dim = dim
+        self.embed_latency = embed_latency
+        self.embed_latency_per_input = embed_latency_per_input
+        self.first_token_latency = first_token_latency
+        self.token_latency = token_latency
+        self.answer_tokens = answer_tokens
+        self.counts = {"embed_calls": 0, "embed_inputs": 0, "generate_calls": 0}
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        self._thread = threading.Thread(target=self._server.serve_forever, name="stub-ollama", daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}"
+
+    def start(self) -> "StubOllama":
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def reset_counts(self):
+        with self._lock:
+            for k in self.counts:
+                self.counts[k] = 0
+
+    def _count(self, **deltas):
+        with self._lock:
+            for k, n in deltas.items():
+                self.counts[k] += n
+
+    def _handler(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def _json(self, body):
+                data = json.dumps(body).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+                if self.path == "/api/embed":
+                    texts = body.get("input") or []
+                    texts = [texts] if isinstance(texts, str) else texts
+                    stub._count(embed_calls=1, embed_inputs=len(texts))
+                    time.sleep(stub.embed_latency + stub.embed_latency_per_input * len(texts))
+                    self._json({"embeddings": [embedding(t, stub.dim) for t in texts]})
+                elif self.path == "/api/generate":
+                    stub._count(generate_calls=1)
+                    if body.get("stream"):
+                        self._stream()
+                    else:
+                        time.sleep(stub.first_token_latency + stub.token_latency * stub.answer_tokens)
+                        self._json({"response": " ".join(["token"] * stub.answer_tokens), "done": True})
+                else:
+                    self.send_error(404)
+
+            def _stream(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                time.sleep(stub.first_token_latency)
+                for i in range(stub.answer_tokens):
+                    done = i == stub.answer_tokens - 1
+                    line = json.dumps({"response": "token ", "done": done}).encode("utf-8") + b"\n"
+                    self.wfile.write(f"{len(line):x}\r\n".encode() + line + b"\r\n")
+                    self.wfile.flush()
+                    if not done:
+                        time.sleep(stub.token_latency)
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
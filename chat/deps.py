@@ -1,6 +1,8 @@
 from typing import Annotated
 
-from fastapi import Depends
+import httpx
+from fastapi import Depends, Request
+from qdrant_client import AsyncQdrantClient
 
 
 class DB:
@@ -18,3 +20,15 @@ def get_db():
 
 
 DBDep = Annotated[DB, Depends(get_db)]
+
+
+def get_qdrant(request: Request) -> AsyncQdrantClient:
+    return request.app.state.qdrant
+
+
+def get_ollama(request: Request) -> httpx.AsyncClient:
+    return request.app.state.ollama
+
+
+QdrantDep = Annotated[AsyncQdrantClient, Depends(get_qdrant)]
+OllamaDep = Annotated[httpx.AsyncClient, Depends(get_ollama)]
@@ -0,0 +1,191 @@
+import hashlib
+import io
+import re
+from typing import Iterable, Iterator, List, NamedTuple, Optional, Union
+
+try:
+    import tiktoken
+except ImportError:  # optional; the regex estimate is close enough for budgeting
+    tiktoken = None
+
+# context windows (tokens) of the embedding models we run; chunks are capped below these
+EMBED_CONTEXT = {
+    "nomic-embed-text": 8192,
+    "mxbai-embed-large": 512,
+    "all-minilm": 256,
+    "snowflake-arctic-embed": 512,
+    "bge-m3": 8192,
+}
+
+_HEADING = re.compile(r"^(#{1,6})\s+(.*\S)\s*$")
+_LIST_ITEM = re.compile(r"^\s*(?:[-*+•]|\d+[.)])\s+")
+_TABLE_ROW = re.compile(r"^\s*\|.*\|\s*$")
+_FENCE = re.compile(r"^\s*(```|~~~)")
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+(?=[\"'(\[]?[A-Z0-9])")
+_TOKEN = re.compile(r"\w+|[^\w\s]")
+# bump when chunk boundaries change for the same settings, so documents are chunked again
+CHUNKER_VERSION = 2
+# a sentence closes a chunk (once it is past min_tokens) when its hash hits this modulus; boundaries therefore
+# depend on content rather than position, so an edit only moves the boundaries of the chunks around it
+_ANCHOR_EVERY = 8
+
+
+class Chunk(NamedTuple):
+    hash: str
+    text: str
+    index: int
+    start: int
+    section: str
+
+
+class _Unit(NamedTuple):
+    text: str
+    start: int
+    tokens: int
+    heading: Optional[str] = None
+
+
+class TokenCounter:
+    def __init__(self, encoding: str = "cl100k_base"):
+        self._enc = tiktoken.get_encoding(encoding) if tiktoken else None
+
+    def count(self, text: str) -> int:
+        if self._enc is not None:
+            return len(self._enc.encode(text, disallowed_special=()))
+        return len(_TOKEN.findall(text))
+
+
+def _iter_lines(source: Union[str, Iterable[str]]) -> Iterator[str]:
+    if isinstance(source, str):
+        yield from io.StringIO(source)
+        return
+    carry = ""
+    for piece in source:
+        carry += piece
+        *lines, carry = carry.split("\n")
+        for line in lines:
+            yield line + "\n"
+    if carry:
+        yield carry
+
+
+def _sentences(paragraph: str, start: int, counter: TokenCounter) -> Iterator[_Unit]:
+    pos = 0
+    for m in _SENTENCE_END.finditer(paragraph):
+        text = paragraph[pos : m.end()]
+        yield _Unit(text, start + pos, counter.count(text))
+        pos = m.end()
+    if pos < len(paragraph):
+        text = paragraph[pos:]
+        yield _Unit(text, start + pos, counter.count(text))
+
+
+def _iter_units(lines: Iterable[str], counter: TokenCounter) -> Iterator[_Unit]:
+    # headings, list items, table rows and code lines are units of their own; prose is split into sentences
+    para, para_start, offset, in_code = [], 0, 0, False
+
+    def flush():
+        if para:
+            yield from _sentences("".join(para), para_start, counter)
+            para.clear()
+
+    for line in lines:
+        if _FENCE.match(line):
+            yield from flush()
+            in_code = not in_code
+            yield _Unit(line, offset, counter.count(line))
+        elif in_code or _LIST_ITEM.match(line) or _TABLE_ROW.match(line):
+            yield from flush()
+            yield _Unit(line, offset, counter.count(line))
+        elif _HEADING.match(line):
+            yield from flush()
+            yield _Unit(line, offset, counter.count(line), heading=_HEADING.match(line).group(2))
+        elif not line.strip():
+            para.append(line)
+            yield from flush()
+        else:
+            if not para:
+                para_start = offset
+            para.append(line)
+        offset += len(line)
+    yield from flush()
+
+
+def _split_long(unit: _Unit, max_tokens: int, counter: TokenCounter) -> Iterator[_Unit]:
+    words = re.split(r"(?<=\s)", unit.text)
+    piece, pos = "", unit.start
+    for w in words:
+        if piece and counter.count(piece + w) > max_tokens:
+            yield _Unit(piece, pos, counter.count(piece))
+            pos += len(piece)
+            piece = ""
+        piece += w
+    if piece:
+        yield _Unit(piece, pos, counter.count(piece))
+
+
+def _is_anchor(text: str) -> bool:
+    return int(hashlib.sha1(text.strip().encode("utf-8")).hexdigest()[:8], 16) % _ANCHOR_EVERY == 0
+
+
+def iter_token_chunks(
+    source: Union[str, Iterable[str]],
+    max_tokens: int = 512,
+    min_tokens: int = 128,
+    overlap_tokens: int = 64,
+    counter: Optional[TokenCounter] = None,
+) -> Iterator[Chunk]:
+    counter = counter or TokenCounter()
+    min_tokens = min(min_tokens, max_tokens)
+    overlap_tokens = min(overlap_tokens, min_tokens // 2)
+    buf: List[_Unit] = []
+    fresh, index, section = 0, 0, ""
+
+    def emit():
+        nonlocal buf, fresh, index
+        text = "".join(u.text for u in buf)
+        if text.strip() and fresh:
+            yield Chunk(hashlib.sha1(text.encode("utf-8")).hexdigest(), text, index, buf[0].start, section)
+            index += 1
+        # carry the tail sentences into the next chunk as overlap
+        tail, tokens = [], 0
+        for u in reversed(buf):
+            if u.heading is not None or tokens + u.tokens > overlap_tokens:
+                break
+            tail.insert(0, u)
+            tokens += u.tokens
+        buf, fresh = tail, 0
+
+    for unit in _iter_units(_iter_lines(source), counter):
+        if unit.heading is not None:
+            # sections never share a chunk, so edits in one section leave the others' hashes alone
+            yield from emit()
+            buf, section = [], unit.heading
+        pieces = [unit] if unit.tokens <= max_tokens else _split_long(unit, max_tokens, counter)
+        for u in pieces:
+            if fresh and sum(b.tokens for b in buf) + u.tokens > max_tokens:
+                yield from emit()
+            if sum(b.tokens for b in buf) + u.tokens > max_tokens:
+                buf = []
+            buf.append(u)
+            fresh += u.tokens
+            if sum(b.tokens for b in buf) >= min_tokens and u.heading is None and _is_anchor(u.text):
+                yield from emit()
+    yield from emit()
+
+
+def iter_char_chunks(text: str, window_chars: int = 4500, overlap_chars: int = 600) -> Iterator[Chunk]:
+    i, index, n = 0, 0, len(text or "")
+    while i < n:
+        c = text[i : i + window_chars]
+        if not c:
+            break
+        yield Chunk(hashlib.sha1(c.encode("utf-8")).hexdigest(), c, index, i, "")
+        index += 1
+        i += max(1, window_chars - overlap_chars)
+
+
+def token_budget(embed_model: str, max_tokens: int) -> int:
+    # leave headroom for tokenizer differences between our counter and the model's
+    context = EMBED_CONTEXT.get(embed_model.split(":")[0])
+    return min(max_tokens, int(context * 0.9)) if context else max_tokens
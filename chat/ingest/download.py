@@ -0,0 +1,99 @@
+import hashlib
+import io
+import json
+import os
+import tempfile
+import weakref
+from typing import BinaryIO, Optional
+
+from chat.settings import settings
+
+# bytes requested per read from the upstream response
+CHUNK_SIZE = 1024 * 1024
+
+
+class DownloadTooLarge(RuntimeError):
+    pass
+
+
+def max_bytes(mime_type: str) -> int:
+    # DOWNLOAD_MAX_BYTES_BY_MIME maps a MIME type or prefix ("image/") to a limit; the longest match wins
+    limits = settings.download_limits
+    matches = [prefix for prefix in limits if (mime_type or "").startswith(prefix)]
+    return limits[max(matches, key=len)] if matches else settings.download_max_bytes
+
+
+def limits_fingerprint() -> str:
+    # changes whenever a limit does, so documents skipped as too large are listed and fetched again
+    return json.dumps([settings.download_max_bytes, sorted(settings.download_limits.items())])
+
+
+class Download:
+    # A file being downloaded: kept in memory up to DOWNLOAD_SPOOL_BYTES, then spilled to a temp file on disk.
+    # The sha256 is computed as the bytes arrive; writes past the MIME type's limit raise DownloadTooLarge.
+    def __init__(self, mime_type: str = "", filename: str = "", limit: Optional[int] = None):
+        self.mime_type = mime_type
+        self.filename = filename
+        self.limit = limit if limit is not None else max_bytes(mime_type)
+        self.size = 0
+        self._sha = hashlib.sha256()
+        self._buf: Optional[io.BytesIO] = io.BytesIO()
+        self._file: Optional[BinaryIO] = None
+        self._finalizer = None
+
+    @property
+    def sha256(self) -> str:
+        return self._sha.hexdigest()
+
+    @property
+    def on_disk(self) -> bool:
+        return self._file is not None
+
+    def _spill(self):
+        self._file = tempfile.NamedTemporaryFile(prefix="download-", dir=settings.download_tmp_dir, delete=False)
+        # the temp file goes away with the object even if close() is never reached
+        self._finalizer = weakref.finalize(self, _remove, self._file)
+        self._file.write(self._buf.getbuffer())
+        self._buf = None
+
+    def write(self, data: bytes) -> int:
+        self.size += len(data)
+        if self.size > self.limit:
+            raise DownloadTooLarge(f"{self.filename} exceeds {self.limit} bytes ({self.mime_type})")
+        self._sha.update(data)
+        if self._file is None and self.size > settings.download_spool_bytes:
+            self._spill()
+        (self._file or self._buf).write(data)
+        return len(data)
+
+    def path(self) -> str:
+        # extractors run in other processes and need a file name; small downloads are written out on demand
+        if self._file is None:
+            self._spill()
+        self._file.flush()
+        return self._file.name
+
+    def open(self) -> BinaryIO:
+        if self._file is None:
+            return io.BytesIO(self._buf.getvalue())
+        self._file.flush()
+        return open(self._file.name, "rb")
+
+    def read_text(self) -> str:
+        if self._file is None:
+            return self._buf.getvalue().decode("utf-8", errors="ignore")
+        with self.open() as f:
+            return io.TextIOWrapper(f, encoding="utf-8", errors="ignore").read()
+
+    def close(self):
+        if self._finalizer is not None:
+            self._finalizer()
+        self._buf = None
+
+
+def _remove(f):
+    f.close()
+    try:
+        os.remove(f.name)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,226 @@
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import threading
+from array import array
+
+logger = logging.getLogger(__name__)
+
+# index.bin layout: a fixed header followed by an open-addressed (linear probing) hash table of fixed-size slots.
+# Vectors live in an append-only float32 segment `vectors.<generation>.f32`; compaction writes the next generation
+# and commits it by atomically replacing the index, so a crash never leaves the index pointing into the wrong file.
+_MAGIC = b"EMBIDX01"
+_HEADER = struct.Struct("<8sQQQQ")  # magic, generation, capacity, count, dead_bytes
+_SLOT = struct.Struct("<16sQII")  # key digest, segment offset, dim, reserved
+_EMPTY = bytes(16)
+_MAX_LOAD = 0.7
+_MIN_CAPACITY = 1024
+
+
+def _digest(key: str) -> bytes:
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest()
+
+
+class EmbeddingStore:
+    # One instance per path and process. Writers in different processes take turns (the ingest leader lease), so
+    # open() re-reads the files: another process may have appended, grown the index or compacted since.
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path: str) -> "EmbeddingStore":
+        path = os.path.abspath(path)
+        with cls._instances_lock:
+            store = cls._instances.get(path)
+            if store is None:
+                store = cls._instances[path] = cls(path)
+            else:
+                store.reload()
+            return store
+
+    def __init__(self, path: str, compact_ratio: float = 0.3):
+        self.path = path
+        self.compact_ratio = compact_ratio
+        self._lock = threading.RLock()
+        os.makedirs(path, exist_ok=True)
+        self._index_path = os.path.join(path, "index.bin")
+        if not os.path.exists(self._index_path):
+            self._write_index(self._index_path, 0, _MIN_CAPACITY, [])
+        self._open_index()
+        self._open_segment()
+        self._remove_stale_segments()
+
+    def reload(self):
+        # drop the cached header, segment size and mappings; index.bin may be a new file by now
+        with self._lock:
+            self._close_index()
+            self._close_segment()
+            self._open_index()
+            self._open_segment()
+
+    def _segment_path(self, generation: int) -> str:
+        return os.path.join(self.path, f"vectors.{generation}.f32")
+
+    def _write_index(self, path, generation, capacity, entries):
+        tmp = f"{path}.tmp"
+        table = bytearray(capacity * _SLOT.size)
+        for digest, offset, dim in entries:
+            i = int.from_bytes(digest[:8], "little") % capacity
+            while table[i * _SLOT.size : i * _SLOT.size + 16] != _EMPTY:
+                i = (i + 1) % capacity
+            _SLOT.pack_into(table, i * _SLOT.size, digest, offset, dim, 0)
+        with open(tmp, "wb") as f:
+            f.write(_HEADER.pack(_MAGIC, generation, capacity, len(entries), 0))
+            f.write(table)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+
+    def _open_index(self):
+        self._index_file = open(self._index_path, "r+b")
+        self._index = mmap.mmap(self._index_file.fileno(), 0)
+        magic, self._generation, self._capacity, self._count, self._dead = _HEADER.unpack_from(self._index, 0)
+        if magic != _MAGIC:
+            raise RuntimeError(f"{self._index_path} is not an embedding index")
+
+    def _close_index(self):
+        self._index.flush()
+        self._index.close()
+        self._index_file.close()
+
+    def _open_segment(self):
+        self._segment = open(self._segment_path(self._generation), "a+b")
+        self._segment_size = self._segment.seek(0, os.SEEK_END)
+        self._segment_map = None
+        self._segment_map_size = 0
+
+    def _close_segment(self):
+        if self._segment_map is not None:
+            self._segment_map.close()
+        self._segment.close()
+
+    def _remove_stale_segments(self):
+        current = os.path.basename(self._segment_path(self._generation))
+        for name in os.listdir(self.path):
+            if name.startswith("vectors.") and name.endswith(".f32") and name != current:
+                os.remove(os.path.join(self.path, name))
+
+    def _write_header(self):
+        _HEADER.pack_into(self._index, 0, _MAGIC, self._generation, self._capacity, self._count, self._dead)
+
+    def _probe(self, digest: bytes):
+        i = int.from_bytes(digest[:8], "little") % self._capacity
+        while True:
+            pos = _HEADER.size + i * _SLOT.size
+            slot_digest = self._index[pos : pos + 16]
+            if slot_digest == _EMPTY or slot_digest == digest:
+                return pos, slot_digest == digest
+            i = (i + 1) % self._capacity
+
+    def _entries(self):
+        for i in range(self._capacity):
+            digest, offset, dim, _ = _SLOT.unpack_from(self._index, _HEADER.size + i * _SLOT.size)
+            if digest != _EMPTY:
+                yield digest, offset, dim
+
+    def _grow(self):
+        entries = list(self._entries())
+        self._close_index()
+        self._write_index(self._index_path, self._generation, self._capacity * 2, entries)
+        dead = self._dead
+        self._open_index()
+        self._dead = dead
+        self._write_header()
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, key: str):
+        with self._lock:
+            return self._probe(_digest(key))[1]
+
+    def get(self, key: str):
+        with self._lock:
+            pos, found = self._probe(_digest(key))
+            if not found:
+                return None
+            _, offset, dim, _ = _SLOT.unpack_from(self._index, pos)
+            end = offset + dim * 4
+            if end > self._segment_map_size:
+                if self._segment_map is not None:
+                    self._segment_map.close()
+                self._segment_map = mmap.mmap(self._segment.fileno(), 0, access=mmap.ACCESS_READ)
+                self._segment_map_size = len(self._segment_map)
+            if end > self._segment_map_size:
+                return None
+            vec = array("f")
+            vec.frombytes(self._segment_map[offset:end])
+            return vec.tolist()
+
+    def put(self, key: str, vector):
+        data = array("f", vector).tobytes()
+        digest = _digest(key)
+        with self._lock:
+            if (self._count + 1) > self._capacity * _MAX_LOAD:
+                self._grow()
+            offset = self._segment_size
+            self._segment.write(data)
+            # the vector bytes must reach the file before the index (an mmap) can reference them
+            self._segment.flush()
+            self._segment_size += len(data)
+            pos, found = self._probe(digest)
+            if found:
+                _, _, old_dim, _ = _SLOT.unpack_from(self._index, pos)
+                self._dead += old_dim * 4
+            else:
+                self._count += 1
+            _SLOT.pack_into(self._index, pos, digest, offset, len(vector), 0)
+            self._write_header()
+
+    def put_many(self, items):
+        for key, vector in items:
+            self.put(key, vector)
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            self._segment.flush()
+            self._index.flush()
+
+    def maybe_compact(self):
+        with self._lock:
+            if self._segment_size and self._dead / self._segment_size >= self.compact_ratio:
+                self.compact()
+
+    def compact(self):
+        with self._lock:
+            self.flush()
+            entries = list(self._entries())
+            generation = self._generation + 1
+            live = []
+            with open(self._segment_path(self._generation), "rb") as src, open(
+                self._segment_path(generation), "wb"
+            ) as dst:
+                for digest, offset, dim in sorted(entries, key=lambda e: e[1]):
+                    src.seek(offset)
+                    live.append((digest, dst.tell(), dim))
+                    dst.write(src.read(dim * 4))
+                dst.flush()
+                os.fsync(dst.fileno())
+            logger.info(
+                "compacting embedding store %s: %s live vectors, %s dead bytes reclaimed",
+                self.path,
+                len(live),
+                self._dead,
+            )
+            self._close_index()
+            self._close_segment()
+            capacity = self._capacity
+            while len(live) > capacity * _MAX_LOAD:
+                capacity *= 2
+            self._write_index(self._index_path, generation, capacity, live)
+            self._open_index()
+            self._open_segment()
+            self._remove_stale_segments()
@@ -0,0 +1,53 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Sequence
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from chat.settings import settings
+
+logger = logging.getLogger(__name__)
+
+
+class OllamaEmbedder:
+    def __init__(self, url: str, model: str, batch_size: int, concurrency: int):
+        self.url = url.rstrip("/")
+        self.model = model
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.concurrency)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="embed")
+
+    def _embed_batch(self, texts: Sequence[str]) -> List[List[float]]:
+        r = self.session.post(f"{self.url}/api/embed", json={"model": self.model, "input": list(texts)}, timeout=300)
+        r.raise_for_status()
+        vecs = r.json().get("embeddings") or []
+        if len(vecs) != len(texts):
+            raise RuntimeError(f"Ollama returned {len(vecs)} embeddings for {len(texts)} inputs")
+        return vecs
+
+    def embed(self, texts: Sequence[str]) -> List[List[float]]:
+        batches = [texts[i : i + self.batch_size] for i in range(0, len(texts), self.batch_size)]
+        if len(batches) == 1:
+            return self._embed_batch(batches[0])
+        out = []
+        for vecs in self._executor.map(self._embed_batch, batches):
+            out.extend(vecs)
+        return out
+
+
+_embedder = None
+_embedder_lock = threading.Lock()
+
+
+def get_embedder(url: str, model: str) -> OllamaEmbedder:
+    global _embedder
+    with _embedder_lock:
+        if _embedder is None or (_embedder.url, _embedder.model) != (url.rstrip("/"), model):
+            _embedder = OllamaEmbedder(url, model, settings.embed_batch_size, settings.embed_concurrency)
+        return _embedder
@@ -0,0 +1,335 @@
+import logging
+import multiprocessing
+import os
+import re
+import subprocess
+import tempfile
+import threading
+import zipfile
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeout
+from concurrent.futures import wait
+from concurrent.futures.process import BrokenProcessPool
+from typing import Callable, Dict, List, Optional, Set
+from xml.etree import ElementTree
+
+from chat.settings import settings
+
+from .download import Download
+from .storage_format import to_markdown
+from .store import TextBlobStore
+
+logger = logging.getLogger(__name__)
+
+# bump when an extractor changes its output so cached texts are re-extracted
+EXTRACTOR_VERSION = 1
+TEXT_EXTENSIONS = (".txt", ".md", ".csv", ".json", ".yaml", ".yml")
+PDF_MIME = "application/pdf"
+DOCX_MIME = "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+PPTX_MIME = "application/vnd.openxmlformats-officedocument.presentationml.presentation"
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+IMAGE_MIMES = ("image/png", "image/jpeg", "image/tiff", "image/bmp", "image/gif", "image/webp")
+# a PDF with less text than this per page is treated as scanned and OCRed
+MIN_CHARS_PER_PAGE = 40
+# zip members larger than this (uncompressed) are not parsed; protects the workers from zip bombs
+MAX_XML_BYTES = 64 * 1024 * 1024
+# Confluence pages this small are converted on the calling thread; the round trip to a worker costs more
+INLINE_HTML_CHARS = 4096
+
+_W = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+_A = "{http://schemas.openxmlformats.org/drawingml/2006/main}"
+_S = "{http://schemas.openxmlformats.org/spreadsheetml/2006/main}"
+_HEADING_STYLE = re.compile(r"^(?:Heading|heading)\s*([1-6])$")
+_NUMBERED = re.compile(r"(\d+)\.xml$")
+
+
+class ExtractionError(RuntimeError):
+    pass
+
+
+class ExtractionUnavailable(RuntimeError):
+    # the pool timed out or lost a worker: says nothing about the file, so the document fails its pipeline stage
+    # and is retried instead of being indexed as empty
+    pass
+
+
+def _run(cmd: List[str], timeout: float) -> bytes:
+    try:
+        return subprocess.run(cmd, capture_output=True, check=True, timeout=timeout).stdout
+    except subprocess.TimeoutExpired:
+        raise ExtractionError(f"{cmd[0]} timed out after {timeout}s")
+    except subprocess.CalledProcessError as e:
+        raise ExtractionError(f"{cmd[0]} failed: {e.stderr.decode('utf-8', errors='ignore')[:500]}")
+    except FileNotFoundError:
+        raise ExtractionError(f"{cmd[0]} is not installed")
+
+
+def _ocr_image(path: str, timeout: float) -> str:
+    return _run(["tesseract", path, "-", "-l", settings.extract_ocr_lang], timeout).decode("utf-8", errors="ignore")
+
+
+def _pdf_pages(path: str, timeout: float) -> int:
+    info = _run(["pdfinfo", path], timeout).decode("utf-8", errors="ignore")
+    m = re.search(r"^Pages:\s+(\d+)", info, re.M)
+    return int(m.group(1)) if m else 0
+
+
+def _extract_pdf(path: str, timeout: float) -> str:
+    last = settings.extract_max_pages
+    text = _run(["pdftotext", "-layout", "-enc", "UTF-8", "-l", str(last), path, "-"], timeout).decode(
+        "utf-8", errors="ignore"
+    )
+    pages = min(_pdf_pages(path, timeout) or 1, last)
+    if len(text.strip()) >= MIN_CHARS_PER_PAGE * pages or not settings.extract_ocr:
+        return text
+    # scanned PDF: render pages and OCR them
+    ocr_pages = min(pages, settings.extract_ocr_max_pages)
+    with tempfile.TemporaryDirectory(prefix="ocr-") as tmp:
+        _run(["pdftoppm", "-r", "200", "-gray", "-png", "-l", str(ocr_pages), path, os.path.join(tmp, "p")], timeout)
+        images = sorted(os.listdir(tmp), key=lambda n: int(re.findall(r"\d+", n)[-1]))
+        return "\n\f".join(_ocr_image(os.path.join(tmp, name), timeout) for name in images)
+
+
+def _xml(zf: zipfile.ZipFile, name: str) -> Optional[ElementTree.Element]:
+    try:
+        info = zf.getinfo(name)
+    except KeyError:
+        return None
+    if info.file_size > MAX_XML_BYTES:
+        raise ExtractionError(f"{name} is {info.file_size} bytes uncompressed")
+    return ElementTree.fromstring(zf.read(info))
+
+
+def _numbered(zf: zipfile.ZipFile, prefix: str) -> List[str]:
+    names = [n for n in zf.namelist() if n.startswith(prefix) and _NUMBERED.search(n)]
+    return sorted(names, key=lambda n: int(_NUMBERED.search(n).group(1)))
+
+
+def _docx_paragraph(p: ElementTree.Element) -> str:
+    parts = []
+    for el in p.iter():
+        if el.tag == f"{_W}t" and el.text:
+            parts.append(el.text)
+        elif el.tag == f"{_W}tab":
+            parts.append("\t")
+        elif el.tag in (f"{_W}br", f"{_W}cr"):
+            parts.append("\n")
+    text = "".join(parts).strip()
+    style = p.find(f"{_W}pPr/{_W}pStyle")
+    level = _HEADING_STYLE.match(style.get(f"{_W}val", "")) if style is not None else None
+    if text and level:
+        # Markdown headings so the chunker starts a new section here
+        return f"{'#' * int(level.group(1))} {text}"
+    return text
+
+
+def _docx_blocks(el: ElementTree.Element, lines: List[str]):
+    for child in el:
+        if child.tag == f"{_W}p":
+            lines.append(_docx_paragraph(child))
+        elif child.tag == f"{_W}tbl":
+            # table rows as tab-separated cells
+            for tr in child.iter(f"{_W}tr"):
+                cells = ("".join(t.text or "" for t in tc.iter(f"{_W}t")) for tc in tr.iter(f"{_W}tc"))
+                lines.append("\t".join(cells))
+        else:
+            _docx_blocks(child, lines)
+
+
+def _extract_docx(path: str, timeout: float) -> str:
+    with zipfile.ZipFile(path) as zf:
+        document = _xml(zf, "word/document.xml")
+    if document is None:
+        raise ExtractionError("not a Word document")
+    lines: List[str] = []
+    _docx_blocks(document, lines)
+    return "\n".join(line for line in lines if line.strip())
+
+
+def _extract_pptx(path: str, timeout: float) -> str:
+    out = []
+    with zipfile.ZipFile(path) as zf:
+        slides = _numbered(zf, "ppt/slides/slide")[: settings.extract_max_pages]
+        for n, name in enumerate(slides, start=1):
+            paragraphs = []
+            for p in _xml(zf, name).iter(f"{_A}p"):
+                text = "".join(t.text or "" for t in p.iter(f"{_A}t")).strip()
+                if text:
+                    paragraphs.append(text)
+            notes = _xml(zf, f"ppt/notesSlides/notesSlide{_NUMBERED.search(name).group(1)}.xml")
+            if notes is not None:
+                paragraphs.extend(t.text for t in notes.iter(f"{_A}t") if t.text and t.text.strip())
+            if paragraphs:
+                out.append(f"## Slide {n}\n" + "\n".join(paragraphs))
+    return "\n\n".join(out)
+
+
+def _extract_xlsx(path: str, timeout: float) -> str:
+    out = []
+    with zipfile.ZipFile(path) as zf:
+        shared = []
+        strings = _xml(zf, "xl/sharedStrings.xml")
+        if strings is not None:
+            shared = ["".join(t.text or "" for t in si.iter(f"{_S}t")) for si in strings.iter(f"{_S}si")]
+        workbook = _xml(zf, "xl/workbook.xml")
+        names = [s.get("name") for s in workbook.iter(f"{_S}sheet")] if workbook is not None else []
+        for i, name in enumerate(_numbered(zf, "xl/worksheets/sheet")):
+            rows = []
+            for row in _xml(zf, name).iter(f"{_S}row"):
+                cells = []
+                for c in row.iter(f"{_S}c"):
+                    v = c.find(f"{_S}v")
+                    if c.get("t") == "s" and v is not None:
+                        cells.append(shared[int(v.text)])
+                    elif c.get("t") == "inlineStr":
+                        cells.append("".join(t.text or "" for t in c.iter(f"{_S}t")))
+                    elif v is not None and v.text:
+                        cells.append(v.text)
+                if any(cells):
+                    rows.append("\t".join(cells))
+                if len(rows) >= settings.extract_max_rows:
+                    break
+            if rows:
+                out.append(f"## {names[i] if i < len(names) else f'Sheet {i + 1}'}\n" + "\n".join(rows))
+    return "\n\n".join(out)
+
+
+def _extract_image(path: str, timeout: float) -> str:
+    return _ocr_image(path, timeout) if settings.extract_ocr else ""
+
+
+EXTRACTORS: Dict[str, Callable[[str, float], str]] = {
+    PDF_MIME: _extract_pdf,
+    DOCX_MIME: _extract_docx,
+    PPTX_MIME: _extract_pptx,
+    XLSX_MIME: _extract_xlsx,
+    **{m: _extract_image for m in IMAGE_MIMES},
+}
+EXTENSIONS = {
+    ".pdf": PDF_MIME,
+    ".docx": DOCX_MIME,
+    ".pptx": PPTX_MIME,
+    ".xlsx": XLSX_MIME,
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".jpeg": "image/jpeg",
+    ".tif": "image/tiff",
+    ".tiff": "image/tiff",
+}
+
+
+def resolve_mime(mime_type: str, filename: str) -> str:
+    if mime_type in EXTRACTORS or mime_type.startswith("text/"):
+        return mime_type
+    return EXTENSIONS.get(os.path.splitext(filename.lower())[1], mime_type)
+
+
+def _extract_in_worker(path: str, mime_type: str, timeout: float) -> str:
+    # runs in a pool process; only the file name crosses the process boundary, never the bytes
+    try:
+        return EXTRACTORS[mime_type](path, timeout)
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, ElementTree.ParseError, EOFError, OSError) as e:
+        raise ExtractionError(f"corrupt file: {e}") from None
+    except (IndexError, KeyError, ValueError, TypeError, AttributeError) as e:
+        # well-formed XML that does not look the way the format says, e.g. a shared string index out of range
+        raise ExtractionError(f"unexpected content: {e!r}") from None
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+_pool_lock = threading.Lock()
+# futures running in each pool, so retiring a pool can let the other documents' extractions finish first
+_running: Dict[ProcessPoolExecutor, Set[Future]] = {}
+# one submission per worker: the timeout then covers extraction, not time spent queued behind other documents
+_slots = threading.BoundedSemaphore(max(settings.extract_workers, 1))
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: the ingest process is full of threads, which fork() does not copy safely
+            _pool = ProcessPoolExecutor(
+                max_workers=settings.extract_workers, mp_context=multiprocessing.get_context("spawn")
+            )
+        return _pool
+
+
+def _terminate(pool: ProcessPoolExecutor):
+    # a wedged worker cannot be cancelled, only killed
+    for process in list((pool._processes or {}).values()):
+        process.terminate()
+    pool.shutdown(wait=False, cancel_futures=True)
+
+
+def _reset_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is not None:
+            _terminate(_pool)
+            _running.pop(_pool, None)
+            _pool = None
+
+
+def _retire_pool(pool: ProcessPoolExecutor, wedged: Optional[Future] = None):
+    # new work goes to a fresh pool; the old one is killed once the extractions still running in it are done
+    global _pool
+    with _pool_lock:
+        if _pool is pool:
+            _pool = None
+        others = [f for f in _running.pop(pool, ()) if f is not wedged and not f.done()]
+
+    def terminate():
+        wait(others, timeout=settings.extract_timeout_seconds * 2)
+        _terminate(pool)
+
+    threading.Thread(target=terminate, name="extract-pool-retire", daemon=True).start()
+
+
+def _in_pool(fn: Callable, args: tuple, timeout: float, what: str):
+    with _slots:
+        pool = _get_pool()
+        future = pool.submit(fn, *args)
+        with _pool_lock:
+            _running.setdefault(pool, set()).add(future)
+        try:
+            return future.result(timeout=timeout)
+        except FutureTimeout:
+            _retire_pool(pool, future)
+            raise ExtractionUnavailable(f"extracting {what} timed out")
+        except BrokenProcessPool:
+            _retire_pool(pool)
+            raise ExtractionUnavailable(f"extraction worker died on {what}")
+        finally:
+            with _pool_lock:
+                _running.get(pool, set()).discard(future)
+
+
+def storage_to_text(html: str) -> str:
+    # Confluence storage format; the converter is pure Python, so big pages go to the pool instead of holding the
+    # GIL that the fetch threads need
+    if len(html) <= INLINE_HTML_CHARS:
+        return to_markdown(html)
+    return _in_pool(to_markdown, (html,), settings.extract_timeout_seconds, f"a {len(html)} character page")
+
+
+def extract_text(download: Download) -> str:
+    filename = download.filename or ""
+    mime_type = resolve_mime(download.mime_type or "", filename)
+    if mime_type.startswith("text/") or filename.lower().endswith(TEXT_EXTENSIONS):
+        return download.read_text()
+    if mime_type not in EXTRACTORS or not download.size:
+        return ""
+    if download.size > settings.extract_max_bytes:
+        logger.warning("not extracting %s: %s bytes is over EXTRACT_MAX_BYTES", filename, download.size)
+        return ""
+    # hashed while the download streamed in
+    key = f"extract:{EXTRACTOR_VERSION}:{download.sha256}"
+    blobs = TextBlobStore.open()
+    cached = blobs.get_many([key])
+    if key in cached:
+        return cached[key]
+    timeout = settings.extract_timeout_seconds
+    # CLI calls time out on their own; the pool timeout bounds the pure-Python parsers (and a worker stuck on a file)
+    text = _in_pool(_extract_in_worker, (download.path(), mime_type, timeout), timeout * 2, f"{filename} ({mime_type})")
+    blobs.put_many([(key, text)])
+    return text
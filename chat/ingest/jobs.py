@@ -0,0 +1,182 @@
+import fcntl
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from typing import Any, Dict, Optional
+
+from .orchestrator import run_incremental
+from .pipeline import pipeline_stats
+from .store import STATE_PATH, StateStore
+
+logger = logging.getLogger(__name__)
+STATE_DIR = os.path.dirname(STATE_PATH)
+# every API worker (and host sharing the state volume) runs the scheduler; the flock on this file elects the one
+# that actually ingests, and the kernel releases it if that process dies
+LOCK_PATH = os.environ.get("INGEST_LOCK_PATH", os.path.join(STATE_DIR, "ingest.lock"))
+STATUS_PATH = os.environ.get("INGEST_STATUS_PATH", os.path.join(STATE_DIR, "ingest_status.json"))
+# StateStore namespace of the reindex counters: a request bumps "requested", a run starts by copying it to "handled".
+# "full" asks the next run to reindex everything; that run hands it on to a per-provider flag (see
+# orchestrator.start_full_reindex), which stays until that provider's full pass completes
+STATE_NAMESPACE = "ingest"
+HEARTBEAT_SECONDS = 5.0
+
+_local = threading.Lock()
+_worker: Optional[threading.Thread] = None
+_worker_lock = threading.Lock()
+
+
+def _holder() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def read_status() -> Dict[str, Any]:
+    try:
+        with open(STATUS_PATH, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return {"state": "idle", "runs": 0}
+
+
+def _write_status(status: Dict[str, Any]):
+    os.makedirs(STATE_DIR, exist_ok=True)
+    tmp = f"{STATUS_PATH}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(status, f)
+    os.replace(tmp, STATUS_PATH)
+
+
+class _Lease:
+    def __init__(self, path: str):
+        self.path = path
+        self._fd = None
+
+    def acquire(self) -> bool:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, _holder().encode("utf-8"))
+        self._fd = fd
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+def _request_pending() -> bool:
+    # counters rather than timestamps, so no two clocks are ever compared
+    state = StateStore.get_all(STATE_NAMESPACE)
+    return state.get("requested", 0) > state.get("handled", 0)
+
+
+def request_reindex(full: bool = False):
+    # picked up by whichever process holds the lease, after its current run if one is in progress
+    with StateStore.batch() as state:
+        state.set(STATE_NAMESPACE, "requested", state.get(STATE_NAMESPACE, "requested", 0) + 1)
+        if full:
+            state.set(STATE_NAMESPACE, "full", True)
+
+
+def _heartbeat(status: Dict[str, Any], stop: threading.Event):
+    while not stop.wait(HEARTBEAT_SECONDS):
+        status["heartbeat_at"] = time.time()
+        status["pipelines"] = pipeline_stats()
+        _write_status(status)
+
+
+def _run_once(status: Dict[str, Any]):
+    with StateStore.batch() as state:
+        # requests made from here on are not covered by this run
+        state.set(STATE_NAMESPACE, "handled", state.get(STATE_NAMESPACE, "requested", 0))
+        full = state.get(STATE_NAMESPACE, "full", False)
+        state.delete(STATE_NAMESPACE, "full")
+    started = time.time()
+    status.update(state="running", holder=_holder(), started_at=started, heartbeat_at=started, error=None)
+    _write_status(status)
+    stop = threading.Event()
+    beat = threading.Thread(target=_heartbeat, args=(status, stop), name="ingest-heartbeat", daemon=True)
+    beat.start()
+    totals: Dict[str, int] = {}
+    try:
+        totals = run_incremental(full)
+    except Exception as e:
+        logger.exception("[ingest] run failed: %s", e)
+        status["error"] = str(e)
+        if full:
+            # the run may have failed before flagging the providers; flagging them again next time is harmless
+            StateStore.set(STATE_NAMESPACE, "full", True)
+    finally:
+        stop.set()
+        beat.join()
+    duration = time.time() - started
+    docs = totals.get("changed", 0) + totals.get("deleted", 0)
+    status.update(
+        state="idle",
+        finished_at=time.time(),
+        last_duration_seconds=round(duration, 3),
+        last_documents=totals,
+        documents_per_sec=round(docs / duration, 2) if duration else 0.0,
+        runs=status.get("runs", 0) + 1,
+        pipelines=pipeline_stats(),
+    )
+    _write_status(status)
+    logger.info("[ingest] run finished in %.1fs: %s", duration, totals)
+
+
+def run_ingest_job() -> bool:
+    # scheduler entry point in every worker: runs ingestion only if no other process is; False when skipped
+    if not _local.acquire(blocking=False):
+        return False
+    ran = False
+    try:
+        while True:
+            lease = _Lease(LOCK_PATH)
+            if not lease.acquire():
+                # the holder checks for requests again after releasing, so nothing queued before now is lost
+                logger.debug("ingest lease held by another process, skipping this run")
+                return ran
+            try:
+                status = read_status()
+                _run_once(status)
+                # a /reindex that arrived while this run was going gets a fresh pass
+                while _request_pending():
+                    logger.info("[ingest] reindex requested during the run, running again")
+                    _run_once(status)
+            finally:
+                lease.release()
+            ran = True
+            # one that arrived between the last check and the release found the lease still held
+            if not _request_pending():
+                return True
+    finally:
+        _local.release()
+
+
+def trigger_reindex(full: bool = False) -> Dict[str, Any]:
+    global _worker
+    request_reindex(full)
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=run_ingest_job, name="ingest-reindex", daemon=True)
+            _worker.start()
+    status = job_status()
+    return {"status": "queued" if status["state"] == "running" else "started", "job": status}
+
+
+def job_status() -> Dict[str, Any]:
+    status = read_status()
+    if status.get("state") == "running":
+        # the holder rewrites the file every HEARTBEAT_SECONDS; a silent one died mid-run and its lease is gone
+        status["stale"] = time.time() - status.get("heartbeat_at", 0) > HEARTBEAT_SECONDS * 3
+    status["reindex_requested"] = _request_pending()
+    return status
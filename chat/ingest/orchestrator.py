@@ -1,67 +1,261 @@
-import hashlib
 import logging
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict
 
+from chat import metrics
+from chat.settings import settings
+
+from .chunking import CHUNKER_VERSION, TokenCounter, iter_char_chunks, iter_token_chunks, token_budget
+from .download import limits_fingerprint
+from .pipeline import Pipeline, Stage, register
 from .providers.base import DocItem, Provider
+from .providers.confluence import ConfluenceProvider
 from .providers.gdrive import GDriveProvider
-from .qdrant_ops import delete_doc, upsert_chunks
-from .store import EmbeddingCache, StateStore
+from .providers.onedrive import OneDriveProvider
+from .qdrant_ops import (
+    PointWriter,
+    build_points,
+    delete_doc,
+    delete_stale_chunks,
+    embed_docs,
+    ensure_collection,
+    update_doc_payload,
+)
+from .store import DocManifest, EmbeddingCache, StateStore
 
 logger = logging.getLogger(__name__)
 
 
-def chunk(text, window_chars=4500, overlap_chars=600):
-    out = []
-    i = 0
-    n = len(text or "")
-    while i < n:
-        c = text[i : i + window_chars]
-        if not c:
-            break
-        h = hashlib.sha1(c.encode("utf-8")).hexdigest()
-        out.append((h, c))
-        i += max(1, window_chars - overlap_chars)
-    return out
+_counter = TokenCounter()
+PROVIDERS = {"confluence": ConfluenceProvider, "gdrive": GDriveProvider, "onedrive": OneDriveProvider}
+
+
+def chunk(text):
+    if settings.chunk_mode == "chars":
+        return iter_char_chunks(text)
+    return iter_token_chunks(
+        text,
+        max_tokens=token_budget(settings.embed_model, settings.chunk_max_tokens),
+        min_tokens=settings.chunk_min_tokens,
+        overlap_tokens=settings.chunk_overlap_tokens,
+        counter=_counter,
+    )
+
+
+def chunker_fingerprint() -> str:
+    # everything that decides chunk boundaries; a change re-chunks every document
+    if settings.chunk_mode == "chars":
+        return f"{CHUNKER_VERSION}:chars"
+    max_tokens = token_budget(settings.embed_model, settings.chunk_max_tokens)
+    return f"{CHUNKER_VERSION}:tokens:{max_tokens}:{settings.chunk_min_tokens}:{settings.chunk_overlap_tokens}"
+
+
+def build_pipeline(provider: Provider, cache: EmbeddingCache, manifest: DocManifest, writer: PointWriter) -> Pipeline:
+    def fetch(job):
+        item, content = job
+        return [(item, content or provider.fetch_content(item))]
+
+    def split(job):
+        item, content = job
+        chunks = list(chunk(provider.parse(content).text))
+        # chunks already in Qdrant from the previous version are neither re-embedded nor re-upserted
+        known = manifest.chunk_hashes(item.doc_id)
+        fresh = [c for c in chunks if c.hash not in known]
+        return [(item, content.version, fresh, [c.hash for c in chunks], content.skipped)]
+
+    def embed(docs):
+        # docs from several fetches share one embed_many call so their cache misses are batched together
+        return [(docs, embed_docs([d[:3] for d in docs], cache))]
+
+    def upsert(job):
+        docs, vectors = job
+        for item, version, fresh, hashes, skipped in docs:
+
+            def written(item=item, version=version, fresh=fresh, hashes=hashes, skipped=skipped):
+                # only once the new points are in Qdrant: tidy the old ones and record the document as done
+                if len(fresh) < len(hashes):
+                    update_doc_payload(provider.name, item, version)
+                delete_stale_chunks(provider.name, item.doc_id, hashes)
+                manifest.update(item, version, hashes, skipped)
+
+            writer.add(build_points(provider.name, item, version, fresh, vectors), on_done=written)
+
+    def failed(job, error):
+        # a fetch or parse failure belongs to the document: its points stay, and it is retried in later runs
+        item = job[0]
+        attempts = manifest.fail(item, f"{type(error).__name__}: {error}")
+        logger.warning("[ingest] %s: %s failed (attempt %s): %s", provider.name, item.doc_id, attempts, error)
+
+    size = settings.ingest_queue_size
+    return Pipeline(
+        provider.name,
+        [
+            Stage("fetch", fetch, settings.ingest_fetch_workers, size, on_error=failed),
+            Stage("chunk", split, settings.ingest_chunk_workers, size, on_error=failed),
+            Stage(
+                "embed",
+                embed,
+                settings.ingest_embed_workers,
+                size,
+                batch_weight=lambda doc: len(doc[2]),
+                batch_size=settings.embed_batch_size * settings.embed_concurrency,
+            ),
+            Stage("upsert", upsert, settings.ingest_upsert_workers, size),
+        ],
+    )
+
 
+def _apply_deletes(source: str, doc_ids, manifest: DocManifest, counts: Dict[str, int]):
+    for doc_id in doc_ids:
+        try:
+            delete_doc(source=source, doc_id=doc_id)
+        except Exception as e:
+            logger.exception("[ingest] %s: deleting %s failed: %s", source, doc_id, e)
+            counts["errors"] += 1
+            continue
+        manifest.remove(doc_id)
+        counts["deleted"] += 1
 
-def run_provider(provider: Provider, cache: EmbeddingCache):
+
+def start_full_reindex(source: str):
+    # The flag stays until one of the provider's passes completes, so a failed pass is retried as a full one;
+    # setting it again is a no-op and never empties the manifest twice. The manifest describes what is already
+    # in Qdrant; for a full reindex every document is written again.
+    if not StateStore.get(source, "full_reindex"):
+        DocManifest(source).clear()
+        StateStore.set(source, "full_reindex", True)
+
+
+def run_provider(provider: Provider, cache: EmbeddingCache, full: bool = False) -> Dict[str, int]:
     logger.info("run_provider Provider %s cache %s", provider, cache)
-    try:
-        cursor = StateStore.get(provider.name, "cursor")
-        for change in provider.list_changed(cursor):
-            logger.info("change found in %s", change)
-            # import pdb
-            # pdb.set_trace()
+    if full:
+        start_full_reindex(provider.name)
+    full = StateStore.get(provider.name, "full_reindex", False)
+    chunker = chunker_fingerprint()
+    manifest = DocManifest(provider.name, chunker)
+    writer = PointWriter()
+    pipeline = build_pipeline(provider, cache, manifest, writer)
+    register(pipeline)
+    cursor_seen = False
+    skipped = 0
+    # doc_ids whose last change in the listing is a deletion; applied once the pipeline has drained, because an
+    # earlier change of the same document may still be queued and would otherwise write its points back
+    deleted = set()
+    listed = set()
+    counts = {"changed": 0, "unchanged": 0, "deleted": 0, "failed": 0, "errors": 0}
+    retries = manifest.failed_items(settings.ingest_max_doc_attempts)
+    docs = {
+        result: metrics.INGEST_DOCUMENTS.labels(provider.name, result) for result in ("changed", "unchanged", "deleted")
+    }
+
+    # a full reindex or a chunker change needs every document listed, not just the ones changed since the cursor;
+    # so do new download limits while documents skipped under the old ones wait in the manifest
+    limits = limits_fingerprint()
+    relist = manifest.has_skipped() and StateStore.get(provider.name, "download_limits") != limits
+    since = None
+    if not full and not relist and StateStore.get(provider.name, "chunker") == chunker:
+        since = StateStore.get(provider.name, "cursor")
+
+    def items():
+        nonlocal cursor_seen, skipped
+        for change in provider.list_changed(since):
+            logger.debug("change found in %s", change)
             if isinstance(change, dict) and change.get("deleted"):
                 logger.info("change is deleted  for %s", change)
-                delete_doc(source=provider.name, doc_id=change["doc_id"])
+                deleted.add(change["doc_id"])
                 continue
             if change == "__cursor__":
-                logger.info("change is only cursor  for %s", change)
-
-                StateStore.set(provider.name, "cursor", provider.cursor)
+                cursor_seen = True
+                continue
+            if change == "__complete__":
+                # a full listing: what the manifest has but the listing did not show was deleted in the meantime
+                gone = manifest.doc_ids() - listed
+                if gone:
+                    logger.info("[ingest] %s: %s documents missing from the full listing", provider.name, len(gone))
+                deleted.update(gone)
                 continue
             item: DocItem = change["item"]
-            content = provider.fetch_content(item)
-            chunks = chunk(content.text)
-            logger.info(
-                "up-serting new change for  provider.name-> %s, item-> %s, content.version-> %s, chunks-> %s, cache-> %s",
-                provider.name,
-                item,
-                content.version,
-                chunks,
-                cache,
-            )
-            upsert_chunks(provider.name, item, content.version, chunks, cache)
+            listed.add(item.doc_id)
+            # listed again after a deletion (restored): the upsert replaces whatever points are left
+            deleted.discard(item.doc_id)
+            if manifest.is_current(item):
+                skipped += 1
+                docs["unchanged"].inc()
+                counts["unchanged"] += 1
+                continue
+            docs["changed"].inc()
+            counts["changed"] += 1
+            # providers may hand over content they already downloaded while listing
+            yield item, change.get("content")
+        # documents that failed in earlier runs; the cursor has moved past them, so the listing may not show them
+        for data in retries:
+            item = DocItem(**data)
+            if item.doc_id in listed or item.doc_id in deleted:
+                continue
+            docs["changed"].inc()
+            counts["changed"] += 1
+            yield item, None
+
+    try:
+        pipeline.run(items())
     except Exception as e:
         logger.exception("[ingest] provider %s error: %s", getattr(provider, "name", "?"), e)
-        print(f"[ingest] provider {getattr(provider, 'name', '?')} error: {e}")
+        counts["errors"] += 1
+        return counts
+    finally:
+        writer.close()
+        metrics.INGEST_POINTS.labels(provider.name).inc(writer.points)
+        _apply_deletes(provider.name, deleted, manifest, counts)
+        docs["deleted"].inc(counts["deleted"])
+        manifest.save()
+    # the cursor only moves forward once every document it covers made it into Qdrant or was recorded as failed
+    if cursor_seen and not pipeline.errors and not writer.errors and not counts["errors"]:
+        with StateStore.batch() as state:
+            state.set(provider.name, "cursor", provider.cursor)
+            state.set(provider.name, "chunker", chunker)
+            state.set(provider.name, "download_limits", limits)
+            state.delete(provider.name, "full_reindex")
+    counts["failed"] += pipeline.rejected
+    counts["errors"] += pipeline.errors + writer.errors
+    logger.info(
+        "[ingest] provider %s finished, %s unchanged docs skipped: %s", provider.name, skipped, pipeline.snapshot()
+    )
+    return counts
 
 
-def run_incremental():
+def run_incremental(full: bool = False) -> Dict[str, int]:
+    # one ingest pass over every provider; call through chat.ingest.jobs so only one runs across workers.
+    # full=True (or a newly created collection) flags every provider for a full reindex before anything else runs;
+    # each provider then lists and writes every document again until one of its passes completes
     logger.info("run_incremental")
+    names = [n.strip().lower() for n in settings.ingest_providers.split(",") if n.strip()]
+    for name in names:
+        if name not in PROVIDERS:
+            logger.error("unknown provider %r in INGEST_PROVIDERS (known: %s)", name, ", ".join(PROVIDERS))
+    providers = [PROVIDERS[n] for n in names if n in PROVIDERS]
+    totals = {"changed": 0, "unchanged": 0, "deleted": 0, "failed": 0, "errors": 0}
+    if not providers:
+        return totals
+    if full:
+        for P in providers:
+            start_full_reindex(P.name)
     cache = EmbeddingCache()
-    # for P in (ConfluenceProvider, GDriveProvider, OneDriveProvider):
-    for P in [GDriveProvider]:
-        logger.info("running for %s with %s", P, cache)
-
-        run_provider(P(), cache)
+    try:
+        if ensure_collection():
+            for P in providers:
+                start_full_reindex(P.name)
+        with ThreadPoolExecutor(max_workers=len(providers), thread_name_prefix="provider") as pool:
+            futures = {}
+            for P in providers:
+                logger.info("running for %s with %s", P, cache)
+                futures[pool.submit(lambda P=P: run_provider(P(), cache))] = P
+            for f, P in futures.items():
+                try:
+                    for key, n in f.result().items():
+                        totals[key] += n
+                except Exception as e:
+                    totals["errors"] += 1
+                    logger.exception("[ingest] provider %s error: %s", P.__name__, e)
+    finally:
+        cache.close()
+    return totals
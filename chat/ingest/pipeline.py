@@ -0,0 +1,189 @@
+import logging
+import queue
+import threading
+import time
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from chat import metrics
+
+logger = logging.getLogger(__name__)
+
+_DONE = object()
+
+
+class Stage:
+    def __init__(
+        self,
+        name: str,
+        fn: Callable[[Any], Optional[Iterable[Any]]],
+        workers: int,
+        maxsize: int,
+        batch_weight: Optional[Callable[[Any], int]] = None,
+        batch_size: int = 1,
+        batch_wait: float = 0.2,
+        on_error: Optional[Callable[[Any, Exception], None]] = None,
+    ):
+        # fn receives one item (or, with batch_weight, a list of items) and returns the items for the next stage.
+        # on_error(item, exc) takes over a failure as that item's own (it is "rejected"); without it the failure
+        # counts as a stage error
+        self.name = name
+        self.fn = fn
+        self.workers = max(1, workers)
+        self.inbox: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.batch_weight = batch_weight
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+        self.on_error = on_error
+        self.processed = 0
+        self.errors = 0
+        self.rejected = 0
+        self.busy_seconds = 0.0
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self.pipeline = ""
+        self._stats_lock = threading.Lock()
+
+    def _next_batch(self):
+        # returns (items, done); done tells the worker to exit once the items are processed
+        item = self.inbox.get()
+        if item is _DONE:
+            return [], True
+        if self.batch_weight is None:
+            return [item], False
+        batch, weight = [item], self.batch_weight(item)
+        deadline = time.monotonic() + self.batch_wait
+        while weight < self.batch_size:
+            try:
+                item = self.inbox.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _DONE:
+                return batch, True
+            batch.append(item)
+            weight += self.batch_weight(item)
+        return batch, False
+
+    def _run(self, emit: Callable[[Any], None]):
+        seconds = metrics.INGEST_STAGE_SECONDS.labels(self.pipeline, self.name)
+        items = metrics.INGEST_STAGE_ITEMS.labels(self.pipeline, self.name)
+        errors = metrics.INGEST_STAGE_ERRORS.labels(self.pipeline, self.name)
+        while True:
+            batch, done = self._next_batch()
+            if batch:
+                t0 = time.monotonic()
+                try:
+                    with metrics.timed(f"ingest.{self.name}", provider=self.pipeline, items=len(batch)):
+                        out = self.fn(batch if self.batch_weight is not None else batch[0])
+                        for result in out or ():
+                            emit(result)
+                except Exception as e:
+                    errors.inc()
+                    if self.on_error is not None and self._reject(batch, e):
+                        logger.debug("[ingest] stage %s rejected %s items: %s", self.name, len(batch), e)
+                    else:
+                        with self._stats_lock:
+                            self.errors += 1
+                        logger.exception("[ingest] stage %s failed: %s", self.name, e)
+                elapsed = time.monotonic() - t0
+                seconds.observe(elapsed)
+                items.inc(len(batch))
+                with self._stats_lock:
+                    self.processed += len(batch)
+                    self.busy_seconds += elapsed
+            if done:
+                return
+
+    def _reject(self, batch: List[Any], error: Exception) -> bool:
+        try:
+            for item in batch:
+                self.on_error(item, error)
+        except Exception as e:
+            logger.exception("[ingest] stage %s could not record a failed item: %s", self.name, e)
+            return False
+        with self._stats_lock:
+            self.rejected += len(batch)
+        return True
+
+    def snapshot(self) -> Dict[str, Any]:
+        end = self.finished_at or time.monotonic()
+        elapsed = end - self.started_at if self.started_at else 0.0
+        return {
+            "workers": self.workers,
+            "processed": self.processed,
+            "errors": self.errors,
+            "rejected": self.rejected,
+            "queue_depth": self.inbox.qsize(),
+            "queue_max": self.inbox.maxsize,
+            "busy_seconds": round(self.busy_seconds, 3),
+            "items_per_sec": round(self.processed / elapsed, 2) if elapsed else 0.0,
+            "utilization": round(self.busy_seconds / (elapsed * self.workers), 3) if elapsed else 0.0,
+        }
+
+
+class Pipeline:
+    def __init__(self, name: str, stages: List[Stage]):
+        self.name = name
+        self.stages = stages
+        for stage in stages:
+            stage.pipeline = name
+            metrics.INGEST_QUEUE_DEPTH.labels(name, stage.name).set_function(stage.inbox.qsize)
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+
+    @property
+    def errors(self) -> int:
+        return sum(s.errors for s in self.stages)
+
+    @property
+    def rejected(self) -> int:
+        return sum(s.rejected for s in self.stages)
+
+    def run(self, source: Iterable[Any]):
+        self.started_at = time.time()
+        threads = []
+        for i, stage in enumerate(self.stages):
+            nxt = self.stages[i + 1] if i + 1 < len(self.stages) else None
+            emit = nxt.inbox.put if nxt else (lambda _: None)
+            stage.started_at = time.monotonic()
+            group = [
+                threading.Thread(target=stage._run, args=(emit,), name=f"{self.name}-{stage.name}-{n}", daemon=True)
+                for n in range(stage.workers)
+            ]
+            for t in group:
+                t.start()
+            threads.append(group)
+        try:
+            # put() blocks while the first stage is full, which throttles the producer
+            for item in source:
+                self.stages[0].inbox.put(item)
+        finally:
+            for stage, group in zip(self.stages, threads):
+                for _ in group:
+                    stage.inbox.put(_DONE)
+                for t in group:
+                    t.join()
+                stage.finished_at = time.monotonic()
+            self.finished_at = time.time()
+
+    def snapshot(self) -> Dict[str, Any]:
+        end = self.finished_at or time.time()
+        return {
+            "running": self.finished_at is None,
+            "started_at": self.started_at,
+            "seconds": round(end - self.started_at, 3) if self.started_at else 0.0,
+            "stages": {s.name: s.snapshot() for s in self.stages},
+        }
+
+
+_pipelines: Dict[str, Pipeline] = {}
+_pipelines_lock = threading.Lock()
+
+
+def register(pipeline: Pipeline):
+    with _pipelines_lock:
+        _pipelines[pipeline.name] = pipeline
+
+
+def pipeline_stats() -> Dict[str, Any]:
+    with _pipelines_lock:
+        return {name: p.snapshot() for name, p in _pipelines.items()}
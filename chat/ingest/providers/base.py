@@ -1,6 +1,31 @@
+import email.utils
+import logging
 from dataclasses import dataclass
+from datetime import datetime, timezone
 from typing import Iterable, List, Optional
 
+from ..download import Download, max_bytes
+from ..extract import ExtractionError, extract_text
+
+logger = logging.getLogger(__name__)
+
+
+def retry_after(value: Optional[str], default: float) -> float:
+    # Retry-After is either delay-seconds or an HTTP-date
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return default
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
 
 @dataclass
 class DocItem:
@@ -12,6 +37,7 @@ class DocItem:
     web_url: str
     source: str
     space_key: Optional[str] = None
+    size: Optional[int] = None
 
 
 @dataclass
@@ -19,9 +45,16 @@ class DocContent:
     text: str
     html: Optional[str]
     version: str
+    # downloaded file still to be turned into text by parse()
+    raw: Optional[Download] = None
+    # over the download limit: indexed as empty but not recorded as current, so a raised limit fetches it
+    skipped: bool = False
 
 
 class Provider:
+    # list_changed yields {"item": DocItem, "content"?: DocContent}, {"deleted": True, "doc_id": ...},
+    # "__complete__" once everything listed so far is the whole source (documents it missed are gone),
+    # and "__cursor__" when self.cursor is ready to be saved
     name: str
     cursor: str
 
@@ -30,3 +63,25 @@ class Provider:
 
     def fetch_content(self, item: DocItem) -> DocContent:
         raise NotImplementedError
+
+    def _skip_download(self, item: DocItem) -> Optional[DocContent]:
+        # files the listing already reports as too big are indexed as empty without downloading them
+        if item.size is not None and item.size > max_bytes(item.mime_type):
+            logger.warning("[ingest] %s: skipping %s, %s bytes is over the limit", self.name, item.title, item.size)
+            return DocContent(text="", html=None, version=item.modified_at, skipped=True)
+        return None
+
+    def parse(self, content: DocContent) -> DocContent:
+        # CPU-bound post-processing (e.g. HTML -> text); runs in the pipeline's chunk stage, not the fetch stage
+        if content.raw is None:
+            return content
+        try:
+            text = extract_text(content.raw)
+        except ExtractionError as e:
+            # the file itself is unreadable: indexed as empty, retried when it changes. ExtractionUnavailable
+            # (timeout, dead worker) is not caught and fails the document's stage instead
+            logger.warning("[ingest] %s: could not extract %s: %s", self.name, content.raw.filename, e)
+            text = ""
+        finally:
+            content.raw.close()
+        return DocContent(text=text, html=content.html, version=content.version)
@@ -1,14 +1,22 @@
 import logging
 import os
+import threading
+import time
+from datetime import datetime, timedelta
+from typing import Optional
+from zoneinfo import ZoneInfo
 
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
 
-from chat.ingest.providers.base import DocContent, DocItem, Provider
+from chat.ingest.extract import ExtractionError, storage_to_text
+from chat.ingest.providers.base import DocContent, DocItem, Provider, retry_after
+from chat.settings import settings
 
 logger = logging.getLogger(__name__)
 CONF_BASE = os.environ.get("CONF_BASE")
 CONF_TOKEN = os.environ.get("CONF_TOKEN")
+MAX_RETRIES = 6
 
 
 class ConfluenceProvider(Provider):
@@ -17,25 +25,62 @@ class ConfluenceProvider(Provider):
     def __init__(self):
         self.disabled = not (CONF_BASE and CONF_TOKEN)
         self.cursor = None
+        self.session = requests.Session()
+        self.session.headers["Authorization"] = f"Bearer {CONF_TOKEN}"
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=settings.confluence_max_concurrency))
+        self.session.mount("http://", HTTPAdapter(pool_maxsize=settings.confluence_max_concurrency))
+        self._slots = threading.BoundedSemaphore(settings.confluence_max_concurrency)
 
     def _get(self, path, params=None):
-        headers = {"Authorization": f"Bearer {CONF_TOKEN}"}
-        r = requests.get(f"{CONF_BASE}/rest/api{path}", headers=headers, params=params or {})
+        url = path if path.startswith("http") else f"{CONF_BASE}/rest/api{path}"
+        for attempt in range(MAX_RETRIES):
+            with self._slots:
+                r = self.session.get(url, params=params or {}, timeout=60)
+            if r.status_code not in (429, 503):
+                break
+            delay = retry_after(r.headers.get("Retry-After"), min(60, 2**attempt))
+            logger.warning("Confluence throttled (%s), retrying in %ss", r.status_code, delay)
+            time.sleep(delay)
         r.raise_for_status()
         return r.json()
 
+    @staticmethod
+    def _modified_at(p) -> Optional[datetime]:
+        # version.when carries an offset (UTC on Cloud, the server's zone on Data Center),
+        # e.g. 2024-05-01T09:30:12.000+02:00
+        when = (p.get("version") or {}).get("when") or ""
+        try:
+            parsed = datetime.fromisoformat(when.replace("Z", "+00:00"))
+        except ValueError:
+            return None
+        return parsed if parsed.tzinfo else None
+
+    @staticmethod
+    def _cursor(newest: datetime) -> str:
+        # CQL compares `lastmodified` in the API user's zone, to the minute; the margin covers a wrong zone setting
+        # and clock skew, and the manifest skips whatever the overlap lists again
+        local = newest.astimezone(ZoneInfo(settings.confluence_timezone))
+        return (local - timedelta(minutes=settings.confluence_cursor_margin_minutes)).strftime("%Y-%m-%d %H:%M")
+
     def list_changed(self, since=None):
         if self.disabled:
             return []
         cql = 'type = "page"'
-        start = 0
-        limit = 100
-        while True:
-            data = self._get(
-                "/content/search", {"cql": cql, "limit": limit, "start": start, "expand": "body.storage,space,version"}
-            )
-            batch = data.get("results", [])
-            for p in batch:
+        # cursors written before delta sync were the literal "timestamp"; treat them as a first run
+        full = not since or since == "timestamp"
+        if not full:
+            cql += f' and lastmodified >= "{since}"'
+        cql += " order by lastmodified"
+        newest: Optional[datetime] = None
+        path, params = "/content/search", {"cql": cql, "limit": 100, "expand": "body.storage,space,version"}
+        while path:
+            data = self._get(path, params)
+            for p in data.get("results", []):
+                html = (((p.get("body") or {}).get("storage") or {}).get("value")) or ""
+                version = str(((p.get("version") or {}).get("number") or 0))
+                modified = self._modified_at(p)
+                if modified and (newest is None or modified > newest):
+                    newest = modified
                 yield {
                     "item": DocItem(
                         doc_id=p["id"],
@@ -46,17 +91,30 @@ class ConfluenceProvider(Provider):
                         web_url=f"{CONF_BASE}/pages/{p['id']}",
                         source=self.name,
                         space_key=(p.get("space") or {}).get("key"),
-                    )
+                    ),
+                    # the search already expanded the body, so fetch_content never has to download it again
+                    "content": DocContent(text="", html=html, version=version),
                 }
-            if len(batch) < limit:
-                break
-            start += limit
-        self.cursor = "timestamp"
+            nxt = (data.get("_links") or {}).get("next")
+            path, params = (f"{CONF_BASE}{nxt}", None) if nxt else (None, None)
+        if full:
+            # every page the API user can see; pages deleted or restricted since are the ones the manifest has extra
+            yield "__complete__"
+        # nothing listed: keep the old cursor
+        self.cursor = self._cursor(newest) if newest else (None if full else since)
         yield "__cursor__"
 
     def fetch_content(self, item: DocItem) -> DocContent:
         data = self._get(f"/content/{item.doc_id}", {"expand": "body.storage,version"})
         html = (((data.get("body") or {}).get("storage") or {}).get("value")) or ""
-        text = BeautifulSoup(html, "html.parser").get_text("\n", strip=True)
         version = str(((data.get("version") or {}).get("number") or 0))
-        return DocContent(text=text, html=html, version=version)
+        return DocContent(text="", html=html, version=version)
+
+    def parse(self, content: DocContent) -> DocContent:
+        if content.html and not content.text:
+            # Markdown headings, lists, tables and code blocks; the chunker starts a new section at each heading
+            try:
+                content.text = storage_to_text(content.html)
+            except ExtractionError as e:
+                logger.warning("[ingest] %s: could not convert page: %s", self.name, e)
+        return content
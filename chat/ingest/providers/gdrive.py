@@ -6,12 +6,30 @@ import os,binascii
 from google.oauth2.service_account import Credentials
 from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
+from googleapiclient.http import MediaIoBaseDownload
 
+from chat.ingest.download import CHUNK_SIZE, Download, DownloadTooLarge
 from chat.ingest.providers.base import DocContent, DocItem, Provider
 
 logger = logging.getLogger(__name__)
 GDRIVE_AUTH_JSON_B64 = os.environ.get("GDRIVE_AUTH_JSON_B64")
 SCOPES = ["https://www.googleapis.com/auth/drive.readonly"]
+FILE_FIELDS = "id,name,mimeType,modifiedTime,parents,webViewLink,size"
+CHANGE_FIELDS = f"nextPageToken,newStartPageToken,changes(changeType,fileId,removed,file({FILE_FIELDS},trashed))"
+GOOGLE_APPS_PREFIX = "application/vnd.google-apps."
+# Google-native files have no bytes to download; these are exported, the rest (forms, shortcuts, drawings, sites,
+# folders) are not listed at all
+EXPORT_MIMES = {
+    "application/vnd.google-apps.document": "text/plain",
+    "application/vnd.google-apps.presentation": "text/plain",
+    "application/vnd.google-apps.spreadsheet": "text/csv",
+}
+PAGE_SIZE = 1000
+
+
+class PageTokenInvalid(RuntimeError):
+    pass
+
 
 def _load_sa_info(val: str):
     if not val:
@@ -43,6 +61,12 @@ def _service():
     creds = Credentials.from_service_account_info(info, scopes=SCOPES)
     return build("drive", "v3", credentials=creds, cache_discovery=False)
 
+
+def _indexable(f) -> bool:
+    mime_type = f.get("mimeType") or ""
+    return bool(f.get("id")) and (not mime_type.startswith(GOOGLE_APPS_PREFIX) or mime_type in EXPORT_MIMES)
+
+
 class GDriveProvider(Provider):
     name = "gdrive"
 
@@ -50,91 +74,135 @@ class GDriveProvider(Provider):
         self.svc = _service()
         self.cursor = None
 
-    def list_changed(self, since=None):
-        logger.info("list changes since %s", since)
-
-
-        if not self.svc:
-            return []
+    def _item(self, f) -> DocItem:
+        return DocItem(
+            doc_id=f.get("id", ""),
+            title=f.get("name", "Untitled"),
+            mime_type=f.get("mimeType", ""),
+            modified_at=f.get("modifiedTime", ""),
+            parents=f.get("parents", []) or [],
+            web_url=f.get("webViewLink", ""),
+            source=self.name,
+            size=int(f["size"]) if f.get("size") else None,
+        )
+
+    def _execute(self, req, key):
         try:
-            q = "mimeType != 'application/vnd.google-apps.folder' and trashed = false"
-            resp = self.svc.files().list(
-                q=q,
-                pageSize=100,
-                fields="files(id,name,mimeType,modifiedTime,parents,webViewLink)"
-            ).execute()
+            resp = req.execute()
         except HttpError as e:
+            if key == "changes" and e.resp.status in (400, 404, 410):
+                raise PageTokenInvalid(f"Drive changes token rejected: {e}")
             raise RuntimeError(f"Drive API error: {e}")
-
-        files = resp.get("files")
+        rows = resp.get(key)
         # Defensive checks
-        if files is None:
-            raise RuntimeError(f"Drive response missing 'files' key: {resp!r}")
-        if isinstance(files, str):
+        if rows is None:
+            raise RuntimeError(f"Drive response missing '{key}' key: {resp!r}")
+        if isinstance(rows, str):
             # Likely an HTML error page via proxy; bubble up a clearer message
-            snippet = files[:200].replace("\n", "\\n")
-            raise RuntimeError(f"Drive 'files' is a string (proxy/HTML?): {snippet}")
-        if not isinstance(files, list):
-            raise RuntimeError(f"Drive 'files' has unexpected type: {type(files).__name__}")
-
-        for f in files:
-            if not isinstance(f, dict):
-                # Skip bad entries gracefully
-                continue
-            yield {"item": DocItem(
-                doc_id=f.get("id", ""),
-                title=f.get("name", "Untitled"),
-                mime_type=f.get("mimeType", ""),
-                modified_at=f.get("modifiedTime", ""),
-                parents=f.get("parents", []) or [],
-                web_url=f.get("webViewLink", ""),
-                source=self.name
-            )}
-        self.cursor = "timestamp"
-        yield "__cursor__"
+            snippet = rows[:200].replace("\n", "\\n")
+            raise RuntimeError(f"Drive '{key}' is a string (proxy/HTML?): {snippet}")
+        if not isinstance(rows, list):
+            raise RuntimeError(f"Drive '{key}' has unexpected type: {type(rows).__name__}")
+        return resp, [r for r in rows if isinstance(r, dict)]
+
+    def _full_listing(self):
+        page_token = None
+        while True:
+            resp, files = self._execute(
+                self.svc.files().list(
+                    q="mimeType != 'application/vnd.google-apps.folder' and trashed = false",
+                    pageSize=PAGE_SIZE,
+                    pageToken=page_token,
+                    fields=f"nextPageToken,files({FILE_FIELDS})",
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                ),
+                "files",
+            )
+            for f in files:
+                if _indexable(f):
+                    yield {"item": self._item(f)}
+            page_token = resp.get("nextPageToken")
+            if not page_token:
+                return
+
+    def _changes(self, page_token):
+        while True:
+            resp, changes = self._execute(
+                self.svc.changes().list(
+                    pageToken=page_token,
+                    pageSize=PAGE_SIZE,
+                    spaces="drive",
+                    includeRemoved=True,
+                    supportsAllDrives=True,
+                    includeItemsFromAllDrives=True,
+                    fields=CHANGE_FIELDS,
+                ),
+                "changes",
+            )
+            for c in changes:
+                # shared-drive changes (changeType "drive") carry no file
+                if c.get("changeType", "file") != "file" or not c.get("fileId"):
+                    continue
+                f = c.get("file") or {}
+                if c.get("removed") or f.get("trashed"):
+                    yield {"deleted": True, "doc_id": c["fileId"]}
+                elif _indexable(f):
+                    yield {"item": self._item(f)}
+            if resp.get("newStartPageToken"):
+                self.cursor = resp["newStartPageToken"]
+                return
+            page_token = resp.get("nextPageToken")
+
+    def list_changed(self, since=None):
+        logger.info("list changes since %s", since)
 
         if not self.svc:
             return []
-        q = "mimeType != 'application/vnd.google-apps.folder' and trashed = false"
-        req = self.svc.files().list(q=q, fields="files(id,name,mimeType,modifiedTime,parents,webViewLink)")
-        resp = req.execute()
-        logger.info('list_changed resp %s', resp)
-        for f in resp.get("files", []):
-            yield {
-                "item": DocItem(
-                    doc_id=f["id"],
-                    title=f.get("name", "Untitled"),
-                    mime_type=f.get("mimeType", ""),
-                    modified_at=f.get("modifiedTime", ""),
-                    parents=f.get("parents", []),
-                    web_url=f.get("webViewLink", ""),
-                    source=self.name,
-                )
-            }
-        self.cursor = "timestamp"
+        # cursors written before delta sync were the literal "timestamp"; treat them as a first run
+        if since and since != "timestamp":
+            try:
+                yield from self._changes(since)
+                yield "__cursor__"
+                return
+            except PageTokenInvalid as e:
+                logger.warning("Drive changes token %s rejected, falling back to full listing: %s", since, e)
+        # take the token before listing so changes made during the listing are picked up next run
+        start = self.svc.changes().getStartPageToken(supportsAllDrives=True).execute()["startPageToken"]
+        yield from self._full_listing()
+        # the listing holds every live file but no removals; the orchestrator diffs it against the manifest
+        yield "__complete__"
+        self.cursor = start
         yield "__cursor__"
 
     def fetch_content(self, item: DocItem) -> DocContent:
 
         logger.info("fetch_content %s", item)
         mt = item.mime_type or ""
-        # Export Google Docs to text if possible
-        export_map = {"application/vnd.google-apps.document": "text/plain"}
         try:
-            if mt in export_map:
-                data = self.svc.files().export(fileId=item.doc_id, mimeType=export_map[mt]).execute()
+            if mt in EXPORT_MIMES:
+                data = self.svc.files().export(fileId=item.doc_id, mimeType=EXPORT_MIMES[mt]).execute()
                 text = data.decode("utf-8", errors="ignore")
                 return DocContent(text=text, html=None, version=item.modified_at)
 
-            # Binary download
-            data = self.svc.files().get_media(fileId=item.doc_id).execute()
-            text = ""
+            skipped = self._skip_download(item)
+            if skipped:
+                return skipped
+            # Binary download, streamed in chunks into a spooled file; parse() turns it into text in the chunk stage
+            download = Download(mt, item.title)
             try:
-                if mt.startswith("text/") or item.title.lower().endswith(
-                        (".txt", ".md", ".csv", ".json", ".yaml", ".yml")):
-                    text = data.decode("utf-8", errors="ignore")
-            except Exception:
-                pass
-            return DocContent(text=text, html=None, version=item.modified_at)
+                request = self.svc.files().get_media(fileId=item.doc_id)
+                downloader = MediaIoBaseDownload(download, request, chunksize=CHUNK_SIZE)
+                done = False
+                while not done:
+                    _, done = downloader.next_chunk()
+            except DownloadTooLarge as e:
+                download.close()
+                logger.warning("[ingest] gdrive: %s", e)
+                return DocContent(text="", html=None, version=item.modified_at, skipped=True)
+            except BaseException:
+                download.close()
+                raise
+            return DocContent(text="", html=None, version=item.modified_at, raw=download)
         except HttpError as e:
             raise RuntimeError(f"Drive download/export error for {item.doc_id}: {e}")
@@ -1,9 +1,12 @@
 import logging
 import os
+import time
 
 import requests
+from requests.adapters import HTTPAdapter
 
-from chat.ingest.providers.base import DocContent, DocItem, Provider
+from chat.ingest.download import CHUNK_SIZE, Download, DownloadTooLarge
+from chat.ingest.providers.base import DocContent, DocItem, Provider, retry_after
 
 logger = logging.getLogger(__name__)
 
@@ -11,6 +14,15 @@ TENANT = os.environ.get("GRAPH_TENANT_ID")
 CLIENT_ID = os.environ.get("GRAPH_CLIENT_ID")
 CLIENT_SECRET = os.environ.get("GRAPH_CLIENT_SECRET")
 SITE_ID = os.environ.get("ONEDRIVE_SITE_ID")
+GRAPH_BASE = "https://graph.microsoft.com/v1.0"
+DELTA_SELECT = "id,name,file,folder,deleted,lastModifiedDateTime,parentReference,webUrl,size"
+# refresh the app token this many seconds before Graph would reject it
+TOKEN_SKEW = 300
+MAX_RETRIES = 5
+
+
+class DeltaResyncRequired(RuntimeError):
+    pass
 
 
 class OneDriveProvider(Provider):
@@ -18,7 +30,10 @@ class OneDriveProvider(Provider):
 
     def __init__(self):
         self._token = None
+        self._token_expires_at = 0.0
         self.cursor = None
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=16))
 
     def _get_token(self):
         if not (TENANT and CLIENT_ID and CLIENT_SECRET):
@@ -30,54 +45,102 @@ class OneDriveProvider(Provider):
             "grant_type": "client_credentials",
             "scope": "https://graph.microsoft.com/.default",
         }
-        r = requests.post(url, data=data, timeout=60)
+        r = self.session.post(url, data=data, timeout=60)
         r.raise_for_status()
-        return r.json()["access_token"]
+        body = r.json()
+        self._token_expires_at = time.time() + int(body.get("expires_in", 3600)) - TOKEN_SKEW
+        return body["access_token"]
 
-    def _graph(self, path, params=None, binary=False):
-        if not self._token:
-            self._token = self._get_token()
-        if not self._token:
-            return None
-        headers = {"Authorization": f"Bearer {self._token}"}
-        r = requests.get(f"https://graph.microsoft.com/v1.0/{path}", headers=headers, params=params or {}, timeout=60)
-        if binary:
+    def _graph(self, path, params=None, stream=False):
+        # with stream=True the open response is returned for the caller to read (and close)
+        # `path` is either relative to GRAPH_BASE or an absolute @odata.nextLink / @odata.deltaLink
+        url = path if path.startswith("https://") else f"{GRAPH_BASE}/{path}"
+        for attempt in range(MAX_RETRIES):
+            if not self._token or time.time() >= self._token_expires_at:
+                self._token = self._get_token()
+            if not self._token:
+                return None
+            headers = {"Authorization": f"Bearer {self._token}"}
+            r = self.session.get(url, headers=headers, params=params or {}, timeout=60, stream=stream)
+            if r.status_code == 401 and attempt == 0:
+                r.close()
+                self._token = None
+                continue
+            if r.status_code in (429, 503):
+                r.close()
+                delay = retry_after(r.headers.get("Retry-After"), 2**attempt)
+                logger.warning("Graph throttled (%s), retrying in %ss", r.status_code, delay)
+                time.sleep(delay)
+                continue
+            if r.status_code == 410:
+                raise DeltaResyncRequired(r.text[:200])
             r.raise_for_status()
-            return r.content
-        r.raise_for_status()
-        return r.json()
+            return r if stream else r.json()
+        raise RuntimeError(f"Graph request {url} still throttled after {MAX_RETRIES} attempts")
+
+    def _delta(self, url):
+        while url:
+            data = self._graph(url) or {}
+            for it in data.get("value", []):
+                if "deleted" in it:
+                    yield {"deleted": True, "doc_id": it["id"]}
+                    continue
+                if it.get("folder") or not it.get("file"):
+                    continue
+                yield {
+                    "item": DocItem(
+                        doc_id=it["id"],
+                        title=it.get("name", "Untitled"),
+                        mime_type=it.get("file", {}).get("mimeType", ""),
+                        modified_at=it.get("lastModifiedDateTime", ""),
+                        parents=[it.get("parentReference", {}).get("path", "")],
+                        web_url=it.get("webUrl", ""),
+                        source=self.name,
+                        size=it.get("size"),
+                    )
+                }
+            url = data.get("@odata.nextLink")
+            if not url:
+                self.cursor = data.get("@odata.deltaLink")
 
     def list_changed(self, since=None):
         if not (TENANT and CLIENT_ID and CLIENT_SECRET):
             return []
         drive_path = f"sites/{SITE_ID}/drive" if SITE_ID else "me/drive"
-        data = self._graph(f"{drive_path}/root/children?$top=100")
-        for it in (data or {}).get("value", []):
-            if it.get("folder"):
-                continue
-            yield {
-                "item": DocItem(
-                    doc_id=it["id"],
-                    title=it.get("name", "Untitled"),
-                    mime_type=it.get("file", {}).get("mimeType", ""),
-                    modified_at=it.get("lastModifiedDateTime", ""),
-                    parents=[it.get("parentReference", {}).get("path", "")],
-                    web_url=it.get("webUrl", ""),
-                    source=self.name,
-                )
-            }
-        self.cursor = "timestamp"
+        full = f"{GRAPH_BASE}/{drive_path}/root/delta?$select={DELTA_SELECT}"
+        # cursors written before delta sync were the literal "timestamp"; treat them as a first run
+        start = since if since and since.startswith("https://") else full
+        try:
+            yield from self._delta(start)
+            complete = start == full
+        except DeltaResyncRequired as e:
+            logger.warning("Graph delta token expired, resyncing the whole drive: %s", e)
+            yield from self._delta(full)
+            complete = True
+        if complete:
+            # a delta from scratch lists every item but not the ones deleted in the meantime
+            yield "__complete__"
         yield "__cursor__"
 
     def fetch_content(self, item: DocItem) -> DocContent:
         drive_path = f"sites/{SITE_ID}/drive" if SITE_ID else "me/drive"
-        content = self._graph(f"{drive_path}/items/{item.doc_id}/content", binary=True)
-        text = ""
+        skipped = self._skip_download(item)
+        if skipped:
+            return skipped
+        r = self._graph(f"{drive_path}/items/{item.doc_id}/content", stream=True)
+        if r is None:
+            return DocContent(text="", html=None, version=item.modified_at)
+        # streamed in chunks into a spooled file; parse() turns it into text in the chunk stage
+        download = Download(item.mime_type, item.title)
         try:
-            if item.mime_type and item.mime_type.startswith("text/"):
-                text = content.decode("utf-8", errors="ignore")
-            elif item.title.lower().endswith((".txt", ".md", ".csv", ".json", ".yaml", ".yml")):
-                text = content.decode("utf-8", errors="ignore")
-        except Exception:
-            pass
-        return DocContent(text=text, html=None, version=item.modified_at)
+            with r:
+                for block in r.iter_content(chunk_size=CHUNK_SIZE):
+                    download.write(block)
+        except DownloadTooLarge as e:
+            download.close()
+            logger.warning("[ingest] onedrive: %s", e)
+            return DocContent(text="", html=None, version=item.modified_at, skipped=True)
+        except BaseException:
+            download.close()
+            raise
+        return DocContent(text="", html=None, version=item.modified_at, raw=download)
@@ -1,63 +1,331 @@
 import logging
 import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 
 from qdrant_client import QdrantClient
 from qdrant_client.models import (
+    BinaryQuantization,
+    BinaryQuantizationConfig,
+    CollectionParamsDiff,
+    Disabled,
     Distance,
     FieldCondition,
     Filter,
+    HnswConfigDiff,
+    MatchAny,
     MatchValue,
+    Modifier,
+    PayloadSchemaType,
     PointStruct,
+    ScalarQuantization,
+    ScalarQuantizationConfig,
+    ScalarType,
+    SparseVector,
+    SparseVectorParams,
     VectorParams,
+    VectorParamsDiff,
 )
 
+from chat import metrics
+from chat.settings import settings
+
+from .embedder import get_embedder
+from .sparse import SPARSE_VECTOR, document_vector
+from .store import EMBED_MODEL, OLLAMA_URL, StateStore, TextBlobStore
+
 logger = logging.getLogger(__name__)
 QDRANT_URL = os.environ.get("QDRANT_URL", "http://qdrant:6333")
 COLLECTION = os.environ.get("QDRANT_COLLECTION", "confluence")
-qdrant = QdrantClient(url=QDRANT_URL)
+qdrant = QdrantClient(location=QDRANT_URL)
+# fixed namespace so the same (source, doc_id, chunk_hash) always maps to the same point and re-upserts overwrite it
+POINT_NAMESPACE = uuid.UUID("5b0f3c1e-2a49-4c3a-9a53-8d5f1f0e7c21")
+_listeners = []
+# set by ensure_collection: whether the collection has the sparse vector the hybrid search needs
+_sparse_enabled = False
+
+
+def on_change(fn):
+    # fn(source, doc_ids, generation) is called after points of those documents were written or deleted;
+    # generation is the index_generation() that change produced
+    _listeners.append(fn)
+
+
+def index_generation() -> int:
+    # bumped in the StateStore on every change, so processes without the listeners (other API workers, a
+    # command-line ingest) can still tell that the index moved under them
+    return StateStore.get("index", "generation", 0)
+
+
+def _notify(source, doc_ids):
+    generation = StateStore.increment("index", "generation")
+    for fn in _listeners:
+        try:
+            fn(source, doc_ids, generation)
+        except Exception as e:
+            logger.exception("change listener %s failed: %s", fn, e)
+
+
+# every field _build_filter and the delete/update filters match on
+KEYWORD_INDEXES = ("source", "doc_id", "space_key", "chunk_hash")
+
+
+def _quantization_config():
+    mode = settings.qdrant_quantization
+    if mode == "scalar":
+        return ScalarQuantization(
+            scalar=ScalarQuantizationConfig(type=ScalarType.INT8, always_ram=settings.qdrant_quantization_always_ram)
+        )
+    if mode == "binary":
+        return BinaryQuantization(binary=BinaryQuantizationConfig(always_ram=settings.qdrant_quantization_always_ram))
+    return None
+
+
+def _quantization_key(config):
+    # what distinguishes one quantization setup from another, for comparing the wanted config with the stored one
+    if isinstance(config, ScalarQuantization):
+        return "scalar", config.scalar.type, bool(config.scalar.always_ram)
+    if isinstance(config, BinaryQuantization):
+        return "binary", bool(config.binary.always_ram)
+    return type(config).__name__ if config is not None else None
 
 
-def ensure_collection(dim: int):
-    logger.info("ensure_collection dim %s ", dim)
+def _probe_dimension() -> int:
+    return len(get_embedder(OLLAMA_URL, EMBED_MODEL).embed(["dimension probe"])[0])
+
+
+def ensure_collection(dim: int = None) -> bool:
+    # True when the collection was created, i.e. it is empty and needs a full reindex
+    global _sparse_enabled
     cols = [c.name for c in qdrant.get_collections().collections]
-    if COLLECTION not in cols:
-        qdrant.create_collection(COLLECTION, vectors_config=VectorParams(size=dim, distance=Distance.COSINE))
+    hnsw = HnswConfigDiff(m=settings.qdrant_hnsw_m, ef_construct=settings.qdrant_hnsw_ef_construct)
+    created = COLLECTION not in cols
+    if not dim:
+        try:
+            dim = _probe_dimension()
+        except Exception as e:
+            if created:
+                raise
+            logger.warning("could not probe the embedding dimension to check %s against: %s", COLLECTION, e)
+    if created:
+        logger.info("creating collection %s with dim %s", COLLECTION, dim)
+        qdrant.create_collection(
+            COLLECTION,
+            vectors_config=VectorParams(size=dim, distance=Distance.COSINE, on_disk=settings.qdrant_on_disk_vectors),
+            on_disk_payload=settings.qdrant_on_disk_payload,
+            hnsw_config=hnsw,
+            quantization_config=_quantization_config(),
+            sparse_vectors_config={SPARSE_VECTOR: SparseVectorParams(modifier=Modifier.IDF)},
+        )
+    else:
+        info = qdrant.get_collection(COLLECTION)
+        cfg = info.config
+        vectors = cfg.params.vectors
+        if dim and getattr(vectors, "size", dim) != dim:
+            # every upsert would fail batch by batch; stop the run here with the actual cause
+            raise RuntimeError(
+                f"collection {COLLECTION} has dim {vectors.size} but {EMBED_MODEL} produces {dim}; delete it and "
+                "POST /reindex (or /reindex?full=true with a new QDRANT_COLLECTION)"
+            )
+        if (cfg.hnsw_config.m, cfg.hnsw_config.ef_construct) != (hnsw.m, hnsw.ef_construct):
+            logger.info("updating %s hnsw config to %s", COLLECTION, hnsw)
+            qdrant.update_collection(COLLECTION, hnsw_config=hnsw)
+        if bool(getattr(vectors, "on_disk", False)) != settings.qdrant_on_disk_vectors:
+            vectors_diff = {"": VectorParamsDiff(on_disk=settings.qdrant_on_disk_vectors)}
+            qdrant.update_collection(COLLECTION, vectors_config=vectors_diff)
+        if bool(cfg.params.on_disk_payload) != settings.qdrant_on_disk_payload:
+            logger.info("updating %s on_disk_payload to %s", COLLECTION, settings.qdrant_on_disk_payload)
+            qdrant.update_collection(
+                COLLECTION, collection_params=CollectionParamsDiff(on_disk_payload=settings.qdrant_on_disk_payload)
+            )
+        wanted = _quantization_config()
+        if _quantization_key(cfg.quantization_config) != _quantization_key(wanted):
+            logger.info("updating %s quantization to %s", COLLECTION, settings.qdrant_quantization)
+            qdrant.update_collection(COLLECTION, quantization_config=wanted or Disabled.DISABLED)
+    info = qdrant.get_collection(COLLECTION)
+    _sparse_enabled = SPARSE_VECTOR in (info.config.params.sparse_vectors or {})
+    if settings.hybrid_search and not _sparse_enabled:
+        logger.warning(
+            "collection %s has no %r sparse vector; delete it and POST /reindex (or /reindex?full=true with a new "
+            "QDRANT_COLLECTION) to enable hybrid search",
+            COLLECTION,
+            SPARSE_VECTOR,
+        )
+    existing = set((info.payload_schema or {}).keys())
+    for field in KEYWORD_INDEXES:
+        if field not in existing:
+            logger.info("creating keyword payload index on %s.%s", COLLECTION, field)
+            qdrant.create_payload_index(COLLECTION, field_name=field, field_schema=PayloadSchemaType.KEYWORD, wait=True)
+    return created
 
 
 def upsert_chunks(source, doc, version, chunks, cache):
-    logger.info("upsert_chunks source %s, doc %s, version %s, chunks %s, cache %s", source, doc, version, chunks, cache)
+    docs = [(doc, version, chunks)]
+    upsert_docs(source, docs, embed_docs(docs, cache))
+
+
+def embed_docs(docs, cache):
+    return cache.embed_many([(c.hash, c.text) for _, _, chunks in docs for c in chunks])
+
+
+def _doc_payload(source, doc, version):
+    return {
+        "source": source,
+        "doc_id": doc.doc_id,
+        "version": version,
+        "title": doc.title,
+        "url": doc.web_url,
+        "parents": getattr(doc, "parents", []),
+        "modified_at": doc.modified_at,
+        "space_key": getattr(doc, "space_key", None),
+    }
+
+
+def _doc_filter(source, doc_id):
+    return [
+        FieldCondition(key="source", match=MatchValue(value=source)),
+        FieldCondition(key="doc_id", match=MatchValue(value=doc_id)),
+    ]
+
+
+def point_id(source, doc_id, chunk_hash) -> str:
+    return str(uuid.uuid5(POINT_NAMESPACE, f"{source}:{doc_id}:{chunk_hash}"))
+
+
+def build_points(source, doc, version, chunks, vectors):
+    slim = settings.qdrant_payload_mode == "slim"
+    if slim:
+        TextBlobStore.open().put_many([(c.hash, c.text) for c in chunks])
     points = []
-    for h, text in chunks:
-        vec = cache.get_or_embed(h, text)
-        pid = f"{source}:{doc.doc_id}:{h}"
-        points.append(
-            PointStruct(
-                id=pid,
-                vector=vec,
-                payload={
-                    "source": source,
-                    "doc_id": doc.doc_id,
-                    "chunk_hash": h,
-                    "version": version,
-                    "title": doc.title,
-                    "url": doc.web_url,
-                    "parents": getattr(doc, "parents", []),
-                    "modified_at": doc.modified_at,
-                    "text": text,
-                    "space_key": getattr(doc, "space_key", None),
-                },
-            )
-        )
+    for c in chunks:
+        payload = {
+            **_doc_payload(source, doc, version),
+            "chunk_hash": c.hash,
+            "chunk_index": c.index,
+            "chunk_start": c.start,
+            "section": c.section,
+        }
+        if slim:
+            payload.pop("parents")
+        else:
+            payload["text"] = c.text
+        vector = vectors[c.hash]
+        if _sparse_enabled:
+            indices, values = document_vector(c.text)
+            vector = {"": vector, SPARSE_VECTOR: SparseVector(indices=indices, values=values)}
+        points.append(PointStruct(id=point_id(source, doc.doc_id, c.hash), vector=vector, payload=payload))
+    return points
+
+
+def upsert_docs(source, docs, vectors):
+    logger.info("upsert_docs source %s, %s docs", source, len(docs))
+    points = [p for doc, version, chunks in docs for p in build_points(source, doc, version, chunks, vectors)]
     if points:
         qdrant.upsert(collection_name=COLLECTION, wait=True, points=points)
+    _notify(source, [doc.doc_id for doc, _, _ in docs])
 
 
-def delete_doc(source, doc_id):
-    logger.info("delete doc -> source %s, doc_id -> %S ", source, doc_id)
-    flt = Filter(
-        must=[
-            FieldCondition(key="source", match=MatchValue(value=source)),
-            FieldCondition(key="doc_id", match=MatchValue(value=doc_id)),
-        ]
+class PointWriter:
+    # Accumulates points across documents into batches and sends them with wait=False, several at a time.
+    # The newest full batch is held back; close() sends it (plus any remainder) with wait=True as the barrier:
+    # Qdrant applies a collection's updates in order, so that acknowledgement covers every earlier batch too.
+    def __init__(self, batch_size: int = None, parallelism: int = None):
+        self.batch_size = batch_size or settings.qdrant_upsert_batch_size
+        parallelism = parallelism or settings.qdrant_upsert_parallelism
+        self._pool = ThreadPoolExecutor(max_workers=parallelism, thread_name_prefix="qdrant-upsert")
+        self._slots = threading.BoundedSemaphore(parallelism * 2)
+        self._lock = threading.Lock()
+        self._batch = []
+        self._held = []
+        self._futures = []
+        self.points = 0
+        self.errors = 0
+
+    def add(self, points, on_done=None):
+        # on_done runs as soon as every batch holding these points is acknowledged (for wait=False batches that is
+        # Qdrant accepting the update, not the close() barrier); never if one of those batches failed
+        group = {"remaining": len(points), "on_done": on_done}
+        if not points:
+            self._finish(group)
+            return
+        ready = []
+        with self._lock:
+            for p in points:
+                self._batch.append((p, group))
+                if len(self._batch) >= self.batch_size:
+                    if self._held:
+                        ready.append(self._held)
+                    self._held, self._batch = self._batch, []
+        # outside the lock: _send needs it to finish, and a slot only frees up once a _send finishes
+        for batch in ready:
+            # blocks while too many batches are in flight, which backs up the upsert stage
+            self._slots.acquire()
+            future = self._pool.submit(self._send, batch, False)
+            with self._lock:
+                self._futures.append(future)
+
+    def _send(self, batch, wait):
+        try:
+            qdrant.upsert(collection_name=COLLECTION, wait=wait, points=[p for p, _ in batch])
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            metrics.UPSTREAM_ERRORS.labels("qdrant", "upsert").inc()
+            logger.exception("[ingest] upsert of %s points failed: %s", len(batch), e)
+            return
+        finally:
+            if not wait:
+                self._slots.release()
+        done = []
+        with self._lock:
+            self.points += len(batch)
+            for _, g in batch:
+                g["remaining"] -= 1
+                if g["remaining"] == 0:
+                    done.append(g)
+        for g in done:
+            self._finish(g)
+
+    def _finish(self, group):
+        if group["on_done"] is None:
+            return
+        try:
+            group["on_done"]()
+        except Exception as e:
+            with self._lock:
+                self.errors += 1
+            logger.exception("[ingest] post-upsert step failed: %s", e)
+
+    def close(self):
+        with self._lock:
+            last, self._held, self._batch = self._held + self._batch, [], []
+        for f in self._futures:
+            f.result()
+        if last:
+            self._send(last, wait=True)
+        self._pool.shutdown()
+
+
+def update_doc_payload(source, doc, version):
+    qdrant.set_payload(
+        collection_name=COLLECTION,
+        payload=_doc_payload(source, doc, version),
+        points=Filter(must=_doc_filter(source, doc.doc_id)),
+        wait=True,
     )
+    _notify(source, [doc.doc_id])
+
+
+def delete_stale_chunks(source, doc_id, keep_hashes):
+    flt = Filter(must=_doc_filter(source, doc_id))
+    if keep_hashes:
+        flt.must_not = [FieldCondition(key="chunk_hash", match=MatchAny(any=list(keep_hashes)))]
     qdrant.delete(collection_name=COLLECTION, points_selector=flt, wait=True)
+    _notify(source, [doc_id])
+
+
+def delete_doc(source, doc_id):
+    logger.info("delete doc -> source %s, doc_id -> %s ", source, doc_id)
+    qdrant.delete(collection_name=COLLECTION, points_selector=Filter(must=_doc_filter(source, doc_id)), wait=True)
+    _notify(source, [doc_id])
@@ -0,0 +1,54 @@
+import re
+import zlib
+from collections import Counter
+from typing import Dict, List, Tuple
+
+SPARSE_VECTOR = "bm25"
+
+# identifiers are kept whole (PROJ-1234, ERR_CONN_RESET, v2.3.1, getUserById) and their parts are added as well,
+# so both "PROJ-1234" and "1234" match
+_TERM = re.compile(r"[A-Za-z0-9]+(?:[._\-/:][A-Za-z0-9]+)*")
+_PART = re.compile(r"[A-Za-z0-9]+")
+_STOPWORDS = frozenset(
+    "a an and are as at be but by for from has have how i if in is it its of on or that the this to was what when "
+    "where which who why will with you your".split()
+)
+# BM25 term-frequency saturation; IDF is applied by Qdrant (Modifier.IDF) from collection statistics
+K1 = 1.2
+B = 0.75
+AVG_DOC_TERMS = 256
+
+
+def terms(text: str) -> List[str]:
+    out = []
+    for m in _TERM.finditer(text):
+        term = m.group(0).lower()
+        parts = _PART.findall(term)
+        if len(parts) > 1:
+            out.append(term)
+        out.extend(p for p in parts if p not in _STOPWORDS)
+    return out
+
+
+def _index(term: str) -> int:
+    # stable across processes and releases (unlike hash()), so ingest and query agree
+    return zlib.crc32(term.encode("utf-8"))
+
+
+def _indexed(weights: Dict[str, float]) -> Tuple[List[int], List[float]]:
+    merged: Dict[int, float] = {}
+    for term, w in weights.items():
+        i = _index(term)
+        merged[i] = merged.get(i, 0.0) + w
+    indices = sorted(merged)
+    return indices, [merged[i] for i in indices]
+
+
+def document_vector(text: str) -> Tuple[List[int], List[float]]:
+    tf = Counter(terms(text))
+    norm = K1 * (1 - B + B * sum(tf.values()) / AVG_DOC_TERMS)
+    return _indexed({t: n * (K1 + 1) / (n + norm) for t, n in tf.items()})
+
+
+def query_vector(text: str) -> Tuple[List[int], List[float]]:
+    return _indexed({t: 1.0 for t in terms(text)})
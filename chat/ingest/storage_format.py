@@ -0,0 +1,317 @@
+import html
+import re
+from typing import Dict, List, Optional, Tuple
+
+# Confluence storage format (XHTML plus ac:/ri: elements) to Markdown-like text: headings become "#" lines, which
+# the chunker treats as section boundaries; lists, tables and code blocks keep their structure. Storage format is
+# well-formed XHTML, so one regex pass over the tags replaces a general HTML parser and no tree is ever built.
+
+HEADINGS = {"h1": 1, "h2": 2, "h3": 3, "h4": 4, "h5": 5, "h6": 6}
+BLOCKS = {
+    "p", "div", "section", "article", "header", "footer", "blockquote", "hr", "dl", "dt", "dd", "figure",
+    "ac:layout", "ac:layout-section", "ac:layout-cell", "ac:rich-text-body", "ac:task-body",
+}  # fmt: skip
+# nothing inside these reaches the text
+SKIPPED = {"script", "style", "head", "ac:parameter", "ac:image", "ac:placeholder", "ac:emoticon", "ac:task-id"}
+# macros rendered by Confluence itself (navigation, reports, embeds); their storage form is only configuration
+DROPPED_MACROS = {
+    "toc", "toc-zone", "children", "pagetree", "pagetreesearch", "recently-updated", "contentbylabel",
+    "content-report-table", "page-properties-report", "attachments", "jira", "jiraissues", "html", "anchor",
+    "livesearch", "gallery", "profile", "contributors", "contributors-summary", "create-from-template",
+    "blog-posts", "viewfile", "view-file", "widget", "multimedia", "roadmap", "change-history",
+}  # fmt: skip
+CODE_MACROS = {"code", "noformat"}
+# panels whose "title" parameter is worth a line of its own
+TITLED_MACROS = {"expand", "panel", "info", "note", "tip", "warning", "details"}
+_WS = re.compile(r"\s+")
+_MARKUP = re.compile(
+    r"<!\[CDATA\[(?P<cdata>.*?)\]\]>"
+    r"|<!--.*?-->"
+    r"|<(?P<close>/?)(?P<tag>[A-Za-z][\w:.-]*)(?P<attrs>(?:\s+[^\s=/>]+(?:\s*=\s*(?:\"[^\"]*\"|'[^']*'|[^\s>]+))?)*)"
+    r"\s*(?P<empty>/?)>"
+    r"|<[!?][^>]*>",
+    re.S,
+)
+_ATTR = re.compile(r"([^\s=/>]+)(?:\s*=\s*(?:\"([^\"]*)\"|'([^']*)'|([^\s>]+)))?")
+
+
+def _attrs(raw: str) -> Dict[str, str]:
+    return {
+        m.group(1).lower(): html.unescape(m.group(2) or m.group(3) or m.group(4) or "") for m in _ATTR.finditer(raw)
+    }
+
+
+class _Table:
+    def __init__(self):
+        self.rows: List[List[str]] = []
+        self.cell: Optional[List[str]] = None
+
+
+class _Macro:
+    def __init__(self, name: str, dropped: bool):
+        self.name = name
+        self.dropped = dropped
+        self.params: Dict[str, str] = {}
+
+
+class StorageFormatConverter:
+    def __init__(self):
+        self.lines: List[str] = []
+        self._text: List[str] = []
+        self._prefix = ""
+        self._tight = False
+        self._skip = 0
+        self._pre = 0
+        self._lists: List[List] = []  # [tag, next number]
+        self._tables: List[_Table] = []
+        self._macros: List[_Macro] = []
+        self._param: Optional[Tuple[str, List[str]]] = None
+        self._link: Optional[Dict] = None
+
+    # output
+
+    def _emit(self, lines: List[str], tight: bool = False):
+        # blocks are separated by a blank line, except consecutive list items
+        if self.lines and not (tight and self._tight) and self.lines[-1]:
+            self.lines.append("")
+        self.lines.extend(lines)
+        self._tight = tight
+
+    def _flush(self):
+        text = "".join(self._text)
+        self._text = []
+        lines = [line.strip() for line in text.split("\n")]
+        lines = [line for line in lines if line]
+        if not lines:
+            # an empty <p> inside a list item keeps the item's marker for the text that follows
+            return
+        prefix, self._prefix = self._prefix, ""
+        if prefix.startswith("#"):
+            self._emit([prefix + " ".join(lines)])
+        elif prefix:
+            indent = " " * len(prefix)
+            self._emit([prefix + lines[0]] + [indent + line for line in lines[1:]], tight=True)
+        else:
+            self._emit(lines)
+
+    def _in_cell(self) -> bool:
+        return bool(self._tables) and self._tables[-1].cell is not None
+
+    def _add(self, text: str):
+        if self._param is not None:
+            self._param[1].append(text)
+        elif self._in_cell():
+            self._tables[-1].cell.append(text)
+        else:
+            self._text.append(text)
+
+    def _break(self):
+        # block boundary: inside a table cell it is just a space, everywhere else it ends the current block
+        if self._in_cell():
+            self._tables[-1].cell.append(" ")
+        else:
+            self._flush()
+
+    def _code(self, text: str, language: str = ""):
+        text = text.strip("\n")
+        if text.strip():
+            self._emit(["```" + language] + text.split("\n") + ["```"])
+
+    def _table_end(self):
+        table = self._tables.pop()
+        rows = [r for r in table.rows if any(r)]
+        if not rows:
+            return
+        if self._in_cell():
+            # nested table: flattened into the outer cell
+            self._tables[-1].cell.append(" " + " ; ".join(" ".join(c for c in r if c) for r in rows) + " ")
+            return
+        self._flush()
+        width = max(len(r) for r in rows)
+        lines = ["| " + " | ".join(r + [""] * (width - len(r))) + " |" for r in rows]
+        lines.insert(1, "|" + " --- |" * width)
+        self._emit(lines)
+
+    # markup events
+
+    def handle_starttag(self, tag: str, attrs: str):
+        if tag == "ac:structured-macro" or tag == "ac:macro":
+            name = (_attrs(attrs).get("ac:name") or "").lower()
+            dropped = name in DROPPED_MACROS
+            self._macros.append(_Macro(name, dropped))
+            if dropped:
+                self._skip += 1
+            return
+        if tag in SKIPPED:
+            self._skip += 1
+            if tag == "ac:parameter" and self._skip == 1:
+                self._param = ((_attrs(attrs).get("ac:name") or "").lower(), [])
+            return
+        if self._skip:
+            return
+        if tag == "ac:task-status":
+            self._skip += 1
+            self._param = ("status", [])
+        elif tag in HEADINGS:
+            self._break()
+            if not self._in_cell():
+                self._prefix = "#" * HEADINGS[tag] + " "
+        elif tag in ("ul", "ol", "ac:task-list"):
+            self._break()
+            self._lists.append([tag, 1])
+        elif tag in ("li", "ac:task"):
+            self._break()
+            depth = max(len(self._lists), 1)
+            kind, number = self._lists[-1] if self._lists else ("ul", 1)
+            if kind == "ol":
+                self._lists[-1][1] += 1
+                marker = f"{number}. "
+            elif kind == "ac:task-list":
+                marker = "- [ ] "
+            else:
+                marker = "- "
+            if not self._in_cell():
+                self._prefix = "  " * (depth - 1) + marker
+        elif tag == "table":
+            self._break()
+            self._tables.append(_Table())
+        elif tag == "tr" and self._tables:
+            self._tables[-1].rows.append([])
+        elif tag in ("td", "th") and self._tables:
+            table = self._tables[-1]
+            if not table.rows:
+                table.rows.append([])
+            table.cell = []
+        elif tag in ("pre", "ac:plain-text-body"):
+            self._flush()
+            self._pre += 1
+        elif tag == "br":
+            self._add(" " if self._in_cell() else "\n")
+        elif tag in BLOCKS:
+            self._break()
+        elif tag == "code" and not self._pre:
+            self._add("`")
+        elif tag == "ac:link":
+            self._link = {"target": "", "text": False}
+        elif tag in ("ri:page", "ri:attachment", "ri:url", "ri:space", "ri:user", "ri:blog-post"):
+            if self._link is not None and not self._link["target"]:
+                a = _attrs(attrs)
+                self._link["target"] = a.get("ri:content-title") or a.get("ri:filename") or a.get("ri:value") or ""
+        elif tag == "time":
+            self._add(_attrs(attrs).get("datetime") or "")
+
+    def handle_endtag(self, tag: str):
+        if tag == "ac:structured-macro" or tag == "ac:macro":
+            if not self._macros:
+                return
+            if self._macros.pop().dropped:
+                self._skip -= 1
+            return
+        if tag in SKIPPED:
+            if not self._skip:
+                return
+            self._skip -= 1
+            if tag == "ac:parameter" and self._skip == 0 and self._param is not None:
+                name, text = self._param
+                self._param = None
+                if self._macros and not self._macros[-1].dropped:
+                    macro = self._macros[-1]
+                    macro.params[name] = "".join(text).strip()
+                    if name == "title" and macro.name in TITLED_MACROS and macro.params[name]:
+                        self._break()
+                        self._add(macro.params[name])
+                        self._break()
+            return
+        if tag == "ac:task-status" and self._param is not None and self._param[0] == "status":
+            status = "".join(self._param[1]).strip().lower()
+            self._param = None
+            self._skip -= 1
+            if status == "complete" and self._prefix.endswith("- [ ] "):
+                self._prefix = self._prefix[: -len("[ ] ")] + "[x] "
+            return
+        if self._skip:
+            return
+        if tag in HEADINGS or tag in ("li", "ac:task"):
+            self._break()
+            if not self._in_cell():
+                self._prefix = ""
+        elif tag in ("ul", "ol", "ac:task-list"):
+            self._break()
+            if self._lists:
+                self._lists.pop()
+        elif tag == "table":
+            if self._tables:
+                self._table_end()
+        elif tag in ("td", "th") and self._tables:
+            table = self._tables[-1]
+            if table.cell is not None:
+                cell = _WS.sub(" ", "".join(table.cell)).strip().replace("|", "\\|")
+                table.rows[-1].append(cell)
+                table.cell = None
+        elif tag in ("pre", "ac:plain-text-body"):
+            self._pre = max(self._pre - 1, 0)
+            macro = self._macros[-1] if self._macros else None
+            if tag == "pre" or (macro is not None and macro.name in CODE_MACROS):
+                text, self._text = "".join(self._text), []
+                self._code(text, macro.params.get("language", "") if tag != "pre" and macro else "")
+            else:
+                self._flush()
+        elif tag in BLOCKS:
+            self._break()
+        elif tag == "code" and not self._pre:
+            self._add("`")
+        elif tag == "ac:link":
+            link, self._link = self._link, None
+            if link is not None and not link["text"] and link["target"]:
+                self._add(link["target"])
+
+    def handle_data(self, data: str):
+        if self._param is not None:
+            self._param[1].append(data)
+            return
+        if self._skip:
+            return
+        if self._pre:
+            (self._tables[-1].cell if self._in_cell() else self._text).append(data)
+            return
+        data = _WS.sub(" ", data)
+        if self._link is not None and data.strip():
+            self._link["text"] = True
+        self._add(data)
+
+    def feed(self, xhtml: str):
+        pos = 0
+        for m in _MARKUP.finditer(xhtml):
+            if m.start() > pos:
+                text = xhtml[pos : m.start()]
+                self.handle_data(html.unescape(text) if "&" in text else text)
+            pos = m.end()
+            tag = m.group("tag")
+            if tag is not None:
+                tag = tag.lower()
+                if m.group("close"):
+                    self.handle_endtag(tag)
+                else:
+                    self.handle_starttag(tag, m.group("attrs"))
+                    if m.group("empty"):
+                        self.handle_endtag(tag)
+            elif m.group("cdata") is not None:
+                # bodies of code macros and plain-text link labels; taken literally
+                self.handle_data(m.group("cdata"))
+        if pos < len(xhtml):
+            text = xhtml[pos:]
+            self.handle_data(html.unescape(text) if "&" in text else text)
+
+    def close(self):
+        while self._tables:
+            self._table_end()
+        self._flush()
+
+
+def to_markdown(xhtml: str) -> str:
+    if not xhtml:
+        return ""
+    parser = StorageFormatConverter()
+    parser.feed(xhtml)
+    parser.close()
+    return "\n".join(parser.lines).strip() + "\n" if parser.lines else ""
@@ -1,66 +1,338 @@
+import dataclasses
 import json
 import logging
 import os
+import sqlite3
 import threading
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional
 
-import requests
+from .embed_store import EmbeddingStore
+from .embedder import get_embedder
 
 logger = logging.getLogger(__name__)
+# the JSON state file of earlier versions; read once to migrate it, then renamed to state.json.migrated
 STATE_PATH = os.environ.get("STATE_PATH", "/app_state/state.json")
+STATE_DB_PATH = os.environ.get("STATE_DB_PATH", os.path.join(os.path.dirname(STATE_PATH), "state.sqlite3"))
+EMBED_STORE_PATH = os.environ.get("EMBED_STORE_PATH", os.path.join(os.path.dirname(STATE_PATH), "embeddings"))
+MANIFEST_DIR = os.environ.get("MANIFEST_DIR", os.path.join(os.path.dirname(STATE_PATH), "manifests"))
+BLOB_STORE_PATH = os.environ.get("BLOB_STORE_PATH", os.path.join(os.path.dirname(STATE_PATH), "chunks.sqlite3"))
 EMBED_MODEL = os.environ.get("EMBED_MODEL", "nomic-embed-text")
 OLLAMA_URL = os.environ.get("OLLAMA_URL", "http://ollama:11434")
 _lock = threading.Lock()
 
 
-def _load():
+def _load_legacy() -> dict:
     try:
         with open(STATE_PATH, "r", encoding="utf-8") as f:
             return json.load(f)
-    except Exception:
+    except FileNotFoundError:
         return {}
+    except Exception as e:
+        logger.warning("ignoring unreadable legacy state file %s: %s", STATE_PATH, e)
+        return {}
+
+
+def _retire_legacy(rest: dict):
+    # whatever is not migrated yet is written back atomically; an emptied file is set aside, never deleted
+    if rest:
+        tmp = f"{STATE_PATH}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(rest, f)
+        os.replace(tmp, STATE_PATH)
+    else:
+        os.replace(STATE_PATH, f"{STATE_PATH}.migrated")
+
+
+class _StateDB:
+    # one connection per process; SQLite's file locks order writers across processes, the RLock across threads
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.pid = os.getpid()
+        self.lock = threading.RLock()
+        self.conn = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            "namespace TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL, PRIMARY KEY (namespace, key)"
+            ") WITHOUT ROWID"
+        )
+        self._migrate_json()
+
+    @contextmanager
+    def transaction(self) -> Iterator[sqlite3.Connection]:
+        with self.lock:
+            if self.conn.in_transaction:
+                # nested in a batch: part of the outer transaction
+                yield self.conn
+                return
+            # IMMEDIATE takes the write lock up front, so a read-modify-write cannot interleave with another process
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self.conn
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def _migrate_json(self):
+        with self.transaction() as conn:
+            data = _load_legacy()
+            rows = [
+                (namespace, key, json.dumps(value))
+                for namespace, values in data.items()
+                if namespace != "_embed_cache" and isinstance(values, dict)
+                for key, value in values.items()
+            ]
+            if not rows:
+                return
+            # keys already in the database are newer than the file
+            conn.executemany("INSERT OR IGNORE INTO state (namespace, key, value) VALUES (?, ?, ?)", rows)
+        # the file goes only once the rows are committed and, despite synchronous=NORMAL, on disk
+        self.conn.execute("PRAGMA wal_checkpoint(FULL)")
+        logger.info("migrated %s state keys from %s to %s", len(rows), STATE_PATH, STATE_DB_PATH)
+        with self.transaction():
+            # another process may have migrated the same file meanwhile; the write lock orders the two
+            data = _load_legacy()
+            if any(k != "_embed_cache" for k in data):
+                # the cached vectors are moved by EmbeddingCache, into the embedding store
+                _retire_legacy({k: v for k, v in data.items() if k == "_embed_cache"})
+
+
+_db: Optional[_StateDB] = None
+
+
+def _state_db() -> _StateDB:
+    global _db
+    with _lock:
+        # a forked child must not share its parent's connection
+        if _db is None or _db.pid != os.getpid():
+            _db = _StateDB(STATE_DB_PATH)
+        return _db
 
 
-def _save(data):
-    os.makedirs(os.path.dirname(STATE_PATH), exist_ok=True)
-    with open(STATE_PATH, "w", encoding="utf-8") as f:
-        json.dump(data, f)
+class StateBatch:
+    # updates made through StateStore.batch(); they commit together or not at all
+    def __init__(self, conn: sqlite3.Connection):
+        self._conn = conn
+
+    def get(self, namespace: str, key: str, default=None):
+        row = self._conn.execute("SELECT value FROM state WHERE namespace = ? AND key = ?", (namespace, key)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def set(self, namespace: str, key: str, value):
+        self._conn.execute(
+            "INSERT OR REPLACE INTO state (namespace, key, value) VALUES (?, ?, ?)", (namespace, key, json.dumps(value))
+        )
+
+    def delete(self, namespace: str, key: str):
+        self._conn.execute("DELETE FROM state WHERE namespace = ? AND key = ?", (namespace, key))
 
 
 class StateStore:
+    # small JSON values (cursors and the like) under (namespace, key) in SQLite, WAL mode: readers never wait for
+    # the writer and every update is a transaction, so a crash cannot leave half-written state
     @staticmethod
     def get(namespace: str, key: str, default=None):
-        with _lock:
-            d = _load()
-            return (d.get(namespace) or {}).get(key, default)
+        db = _state_db()
+        with db.lock:
+            return StateBatch(db.conn).get(namespace, key, default)
+
+    @staticmethod
+    def get_all(namespace: str) -> Dict:
+        db = _state_db()
+        with db.lock:
+            rows = db.conn.execute("SELECT key, value FROM state WHERE namespace = ?", (namespace,)).fetchall()
+        return {key: json.loads(value) for key, value in rows}
 
     @staticmethod
     def set(namespace: str, key: str, value):
-        with _lock:
-            d = _load()
-            d.setdefault(namespace, {})[key] = value
-            _save(d)
+        with StateStore.batch() as batch:
+            batch.set(namespace, key, value)
+
+    @staticmethod
+    def delete(namespace: str, key: str):
+        with StateStore.batch() as batch:
+            batch.delete(namespace, key)
+
+    @staticmethod
+    def increment(namespace: str, key: str) -> int:
+        with StateStore.batch() as batch:
+            value = batch.get(namespace, key, 0) + 1
+            batch.set(namespace, key, value)
+        return value
+
+    @staticmethod
+    @contextmanager
+    def batch() -> Iterator[StateBatch]:
+        with _state_db().transaction() as conn:
+            yield StateBatch(conn)
+
+
+class DocManifest:
+    # (source, doc_id) -> the listing timestamp, content version and chunk hashes last written to Qdrant, plus the
+    # chunker settings that produced them; an entry from other chunker settings, one skipped as too large to
+    # download, or one whose last attempt failed is not current. A failed document keeps its listing item and an
+    # attempt count, so it is retried even when the provider's cursor has moved past it
+    def __init__(self, source: str, chunker: str = ""):
+        self.source = source
+        self.chunker = chunker
+        self.path = os.path.join(MANIFEST_DIR, f"{source}.json")
+        self._lock = threading.Lock()
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                self._docs = json.load(f)
+        except Exception:
+            self._docs = {}
+
+    def is_current(self, item) -> bool:
+        entry = self._docs.get(item.doc_id)
+        return bool(
+            entry
+            and item.modified_at
+            and entry.get("modified_at") == item.modified_at
+            and entry.get("chunker") == self.chunker
+            and not entry.get("skipped")
+            and not entry.get("failed")
+        )
+
+    def chunk_hashes(self, doc_id: str) -> set:
+        return set((self._docs.get(doc_id) or {}).get("chunks") or ())
+
+    def update(self, item, version: str, chunk_hashes, skipped: bool = False):
+        with self._lock:
+            self._docs[item.doc_id] = {
+                "modified_at": item.modified_at,
+                "version": version,
+                "chunks": list(chunk_hashes),
+                "chunker": self.chunker,
+            }
+            if skipped:
+                self._docs[item.doc_id]["skipped"] = True
+
+    def fail(self, item, error: str) -> int:
+        # the previous entry (chunk hashes of what is still in Qdrant) stays; returns the number of attempts so far
+        with self._lock:
+            entry = self._docs.setdefault(item.doc_id, {})
+            attempts = (entry.get("failed") or {}).get("attempts", 0) + 1
+            entry["failed"] = {"attempts": attempts, "error": error[:500], "item": dataclasses.asdict(item)}
+            return attempts
+
+    def failed_items(self, max_attempts: int) -> List[Dict]:
+        # listing items of the documents still worth another attempt
+        with self._lock:
+            return [
+                entry["failed"]["item"]
+                for entry in self._docs.values()
+                if entry.get("failed") and entry["failed"]["attempts"] < max_attempts
+            ]
+
+    def has_skipped(self) -> bool:
+        with self._lock:
+            return any(entry.get("skipped") for entry in self._docs.values())
+
+    def remove(self, doc_id: str):
+        with self._lock:
+            self._docs.pop(doc_id, None)
+
+    def doc_ids(self) -> set:
+        with self._lock:
+            return set(self._docs)
+
+    def clear(self):
+        with self._lock:
+            self._docs = {}
+        self.save()
+
+    def save(self):
+        with self._lock:
+            os.makedirs(MANIFEST_DIR, exist_ok=True)
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self._docs, f)
+            os.replace(tmp, self.path)
+
+
+class TextBlobStore:
+    # chunk text keyed by chunk hash, for collections whose Qdrant payloads omit the text
+    _instances = {}
+    _instances_lock = threading.Lock()
+
+    @classmethod
+    def open(cls, path: str = None) -> "TextBlobStore":
+        path = os.path.abspath(path or BLOB_STORE_PATH)
+        with cls._instances_lock:
+            if path not in cls._instances:
+                cls._instances[path] = cls(path)
+            return cls._instances[path]
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute("CREATE TABLE IF NOT EXISTS blobs (hash TEXT PRIMARY KEY, text TEXT NOT NULL)")
+
+    def put_many(self, items):
+        with self._lock, self._db:
+            self._db.executemany("INSERT OR IGNORE INTO blobs (hash, text) VALUES (?, ?)", items)
+
+    def get_many(self, hashes):
+        hashes = list(set(hashes))
+        out = {}
+        with self._lock:
+            for i in range(0, len(hashes), 500):
+                part = hashes[i : i + 500]
+                rows = self._db.execute(
+                    f"SELECT hash, text FROM blobs WHERE hash IN ({','.join('?' * len(part))})", part
+                )
+                out.update(rows)
+        return out
 
 
 class EmbeddingCache:
     def __init__(self):
-        self._cache = _load().get("_embed_cache") or {}
+        self._store = EmbeddingStore.open(EMBED_STORE_PATH)
+        self._embedder = get_embedder(OLLAMA_URL, EMBED_MODEL)
+        self._migrate_json_cache()
 
-    def _persist(self):
-        with _lock:
-            d = _load()
-            d["_embed_cache"] = self._cache
-            _save(d)
+    def _migrate_json_cache(self):
+        # one-shot import of the vectors that used to live under the `_embed_cache` key of state.json
+        with _state_db().transaction():
+            d = _load_legacy()
+            legacy = d.pop("_embed_cache", None)
+            if not legacy:
+                return
+            logger.info("migrating %s cached embeddings from %s to %s", len(legacy), STATE_PATH, EMBED_STORE_PATH)
+            for key, vec in legacy.items():
+                if key not in self._store:
+                    self._store.put(key, vec)
+            self._store.flush()
+            _retire_legacy(d)
+
+    def close(self):
+        self._store.flush()
+        self._store.maybe_compact()
 
     def get_or_embed(self, chunk_hash: str, text: str):
-        key = f"{EMBED_MODEL}:{chunk_hash}"
-        if key in self._cache:
-            return self._cache[key]
-        r = requests.post(f"{OLLAMA_URL}/api/embeddings", json={"model": EMBED_MODEL, "input": text}, timeout=120)
-        r.raise_for_status()
-        data = r.json()
-        vec = data.get("embedding") or (data.get("embeddings") or [None])[0]
-        if vec is None:
-            raise RuntimeError("No embedding returned from Ollama")
-        self._cache[key] = vec
-        self._persist()
-        return vec
+        return self.embed_many([(chunk_hash, text)])[chunk_hash]
+
+    def embed_many(self, chunks):
+        out, misses = {}, {}
+        for h, text in chunks:
+            if h in out or h in misses:
+                continue
+            vec = self._store.get(f"{EMBED_MODEL}:{h}")
+            if vec is None:
+                misses[h] = text
+            else:
+                out[h] = vec
+        if misses:
+            logger.info("embedding %s cache misses (%s hits)", len(misses), len(out))
+            vecs = self._embedder.embed(list(misses.values()))
+            for h, vec in zip(misses, vecs):
+                self._store.put(f"{EMBED_MODEL}:{h}", vec)
+                out[h] = vec
+        return out
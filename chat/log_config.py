@@ -0,0 +1,108 @@
+import atexit
+import copy
+import json
+import logging
+import logging.config
+import queue
+import threading
+import time
+from logging.handlers import QueueHandler, QueueListener
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from chat.settings import settings
+
+DEFAULT_CONFIG = Path(__file__).parent / "logging.conf"
+# LogRecord attributes that are not user-supplied `extra` fields
+_RESERVED = set(vars(logging.LogRecord("", 0, "", 0, "", None, None))) | {"message", "asctime", "suppressed"}
+
+_listener: Optional[QueueListener] = None
+
+
+def _preview(value, limit: int) -> str:
+    text = value if isinstance(value, str) else repr(value)
+    return text if len(text) <= limit else f"{text[:limit]}… ({len(text)} chars)"
+
+
+class JsonFormatter(logging.Formatter):
+    # one JSON object per line; the message and any `extra` values are cut to LOG_PREVIEW_CHARS
+    def __init__(self, fmt=None, datefmt=None, style="%", validate=True, **kwargs):
+        super().__init__(fmt, datefmt, style, validate, **kwargs)
+        self.preview_chars = settings.log_preview_chars
+
+    def format(self, record: logging.LogRecord) -> str:
+        out = {
+            "ts": round(record.created, 3),
+            "level": record.levelname,
+            "logger": record.name,
+            "thread": record.threadName,
+            "msg": _preview(record.getMessage(), self.preview_chars),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RESERVED and not key.startswith("_"):
+                out[key] = value if isinstance(value, (int, float, bool)) else _preview(value, self.preview_chars)
+        if getattr(record, "suppressed", 0):
+            out["suppressed"] = record.suppressed
+        if record.exc_info:
+            out["exc"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            out["exc"] = record.exc_text
+        return json.dumps(out, ensure_ascii=False, default=str)
+
+
+class SampledDebugFilter(logging.Filter):
+    # Per call site (logger + message template), DEBUG records pass at up to `rate` per second; past that only every
+    # `sample`-th one does, carrying the number of records dropped since the last one that passed.
+    def __init__(self, rate: int, sample: int):
+        super().__init__()
+        self.rate = rate
+        self.sample = max(1, sample)
+        self._sites: Dict[Tuple[str, str], list] = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno > logging.DEBUG:
+            return True
+        now = int(time.monotonic())
+        with self._lock:
+            site = self._sites.setdefault((record.name, str(record.msg)), [now, 0, 0])
+            if site[0] != now:
+                site[0], site[1] = now, 0
+            site[1] += 1
+            if site[1] <= self.rate or site[1] % self.sample == 0:
+                record.suppressed, site[2] = site[2], 0
+                return True
+            site[2] += 1
+            return False
+
+
+class _QueueHandler(QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # merge the args now (they may change after the call returns) but leave the JSON formatting to the listener
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def configure_logging(path: Optional[str] = None):
+    # Reads per-logger levels and handlers from logging.conf, then puts the handlers behind a queue: callers only
+    # enqueue the record, a background thread formats it and does the I/O.
+    global _listener
+    logging.config.fileConfig(path or settings.log_config or DEFAULT_CONFIG, disable_existing_loggers=False)
+    root = logging.getLogger()
+    handlers = list(root.handlers)
+    for h in handlers:
+        root.removeHandler(h)
+    q: queue.Queue = queue.Queue(-1)
+    queue_handler = _QueueHandler(q)
+    queue_handler.addFilter(SampledDebugFilter(settings.log_debug_rate, settings.log_debug_sample))
+    root.addHandler(queue_handler)
+    if _listener is not None:
+        _listener.stop()
+    _listener = QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
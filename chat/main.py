@@ -1,22 +1,19 @@
 import logging
 from contextlib import asynccontextmanager
-from pathlib import Path
 
+import httpx
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
-from fastapi import FastAPI
+from fastapi import FastAPI, Response
+from qdrant_client import AsyncQdrantClient
 
-from chat.ingest.orchestrator import run_incremental
+from chat import metrics
+from chat.ingest.jobs import run_ingest_job
+from chat.log_config import configure_logging
 from chat.settings import settings
 from chat.views.rag_api import get_router
 
-log_path=Path((Path(__file__).parent),'logging.conf')
-# logging.config.fileConfig(log_path)
+configure_logging()
 logger = logging.getLogger("Chat With Docs")
-logging.basicConfig(filename="/tmp/logs/log.log", encoding="utf-8", level=logging.DEBUG)
-#
-# # create console handler and set level to debug
-# ch = logging.StreamHandler()
-# ch.setLevel(logging.DEBUG)
 
 
 scheduler = AsyncIOScheduler()
@@ -25,12 +22,32 @@ scheduler = AsyncIOScheduler()
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logger.info(" start lifespan scheduler")
-    scheduler.add_job(run_incremental, "interval", minutes=settings.ingest_interval_minutes, id="incremental_ingest")
+    # every worker schedules the job; run_ingest_job's file lease lets only one of them ingest at a time
+    scheduler.add_job(
+        run_ingest_job,
+        "interval",
+        minutes=settings.ingest_interval_minutes,
+        id="incremental_ingest",
+        max_instances=1,
+        coalesce=True,
+    )
     scheduler.start()
+    # one pooled client per upstream for the whole process, shared by every request
+    app.state.ollama = httpx.AsyncClient(
+        base_url=settings.ollama_url,
+        timeout=httpx.Timeout(settings.ollama_timeout, connect=10.0),
+        limits=httpx.Limits(
+            max_connections=settings.ollama_max_connections,
+            max_keepalive_connections=settings.ollama_max_connections,
+        ),
+    )
+    app.state.qdrant = AsyncQdrantClient(location=settings.qdrant_url)
     try:
         yield
     finally:
         scheduler.shutdown(wait=False)
+        await app.state.ollama.aclose()
+        await app.state.qdrant.close()
 
 
 app = FastAPI(title="Chat With Docs)", lifespan=lifespan)
@@ -42,4 +59,10 @@ async def health():
     return {"status": "ok"}
 
 
+@app.get("/metrics", tags=["_meta"])
+async def prometheus_metrics():
+    body, content_type = metrics.latest()
+    return Response(content=body, media_type=content_type)
+
+
 app.include_router(get_router())
@@ -0,0 +1,67 @@
+import time
+from contextlib import contextmanager, nullcontext
+
+from prometheus_client import CONTENT_TYPE_LATEST, Counter, Gauge, Histogram, generate_latest
+
+try:
+    from opentelemetry import trace
+except ImportError:  # optional; spans are only emitted when an OpenTelemetry SDK is installed and configured
+    trace = None
+
+_tracer = trace.get_tracer("chat") if trace else None
+
+# query stages are mostly sub-second; generation runs to tens of seconds on CPU
+_FAST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+_SLOW_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+
+QUERY_STAGE_SECONDS = Histogram(
+    "rag_query_stage_seconds", "Time spent in each stage of answering a query", ["stage"], buckets=_FAST_BUCKETS
+)
+GENERATE_SECONDS = Histogram("rag_generate_seconds", "Total answer generation time", ["mode"], buckets=_SLOW_BUCKETS)
+GENERATE_TTFT_SECONDS = Histogram(
+    "rag_generate_time_to_first_token_seconds", "Time until the first streamed answer token", buckets=_SLOW_BUCKETS
+)
+CACHE_LOOKUPS = Counter("rag_cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"])
+UPSTREAM_ERRORS = Counter("rag_upstream_errors_total", "Failed calls to Ollama and Qdrant", ["upstream", "operation"])
+INGEST_STAGE_SECONDS = Histogram(
+    "ingest_stage_seconds",
+    "Time a pipeline stage spends on one item (or batch)",
+    ["provider", "stage"],
+    buckets=_SLOW_BUCKETS,
+)
+INGEST_STAGE_ITEMS = Counter("ingest_stage_items_total", "Items processed by a pipeline stage", ["provider", "stage"])
+INGEST_STAGE_ERRORS = Counter("ingest_stage_errors_total", "Pipeline stage failures", ["provider", "stage"])
+INGEST_QUEUE_DEPTH = Gauge("ingest_queue_depth", "Items waiting in front of a pipeline stage", ["provider", "stage"])
+INGEST_DOCUMENTS = Counter("ingest_documents_total", "Documents seen by ingestion", ["provider", "result"])
+INGEST_POINTS = Counter("ingest_points_total", "Points written to Qdrant", ["provider"])
+
+
+def _span(name: str, attributes: dict):
+    if _tracer is None:
+        return nullcontext()
+    return _tracer.start_as_current_span(name, attributes=attributes)
+
+
+@contextmanager
+def timed(name: str, histogram=None, errors=None, **attributes):
+    # times the block into histogram, counts a failure into errors and wraps it in an OpenTelemetry span
+    start = time.perf_counter()
+    with _span(name, attributes):
+        try:
+            yield
+        except Exception:
+            if errors is not None:
+                errors.inc()
+            raise
+        finally:
+            if histogram is not None:
+                histogram.observe(time.perf_counter() - start)
+
+
+def query_stage(stage: str, upstream: str = None):
+    errors = UPSTREAM_ERRORS.labels(upstream, stage) if upstream else None
+    return timed(f"rag.{stage}", QUERY_STAGE_SECONDS.labels(stage), errors, stage=stage)
+
+
+def latest():
+    return generate_latest(), CONTENT_TYPE_LATEST
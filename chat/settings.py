@@ -1,3 +1,8 @@
+import json
+from functools import cached_property
+from typing import Dict, Optional
+
+from pydantic import field_validator
 from pydantic_settings import BaseSettings
 
 
@@ -8,11 +13,94 @@ class Settings(BaseSettings):
     qdrant_url: str = "http://qdrant:6333"
     qdrant_collection: str = "confluence"
     top_k: int = 6
+    hybrid_search: bool = True
+    hybrid_candidates: int = 20
+    rrf_k: int = 60
+    rerank_mode: str = "mmr"
+    rerank_candidates: int = 50
+    rerank_mmr_lambda: float = 0.7
+    rerank_dedupe_similarity: float = 0.95
+    rerank_model: str = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+    rerank_budget_ms: float = 150.0
     max_context_chars: int = 12000
+    max_context_tokens: Optional[int] = None
     ingest_interval_minutes: int = 10
+    # comma-separated: confluence, gdrive, onedrive
+    ingest_providers: str = "gdrive"
+    log_config: Optional[str] = None
+    log_preview_chars: int = 512
+    log_debug_rate: int = 20
+    log_debug_sample: int = 100
+    ollama_timeout: float = 120.0
+    ollama_max_connections: int = 32
+    answer_cache_size: int = 1024
+    answer_cache_ttl_seconds: float = 3600.0
+    answer_cache_similarity: float = 0.97
+    query_embedding_cache_size: int = 4096
+    query_embedding_cache_ttl_seconds: float = 86400.0
+    embed_batch_size: int = 32
+    embed_concurrency: int = 4
+    chunk_mode: str = "tokens"
+    chunk_max_tokens: int = 512
+    chunk_min_tokens: int = 128
+    chunk_overlap_tokens: int = 64
+    ingest_queue_size: int = 64
+    ingest_fetch_workers: int = 8
+    ingest_chunk_workers: int = 2
+    ingest_embed_workers: int = 2
+    ingest_upsert_workers: int = 2
+    # runs that retry a document whose fetch or parse failed, before it waits for its next change
+    ingest_max_doc_attempts: int = 5
+    confluence_max_concurrency: int = 4
+    # zone CQL compares `lastmodified` in (the API user's profile zone) and how far the cursor is set back
+    confluence_timezone: str = "UTC"
+    confluence_cursor_margin_minutes: int = 60
+    download_spool_bytes: int = 8 * 1024 * 1024
+    download_max_bytes: int = 200 * 1024 * 1024
+    # JSON object of MIME type or prefix -> byte limit, e.g. {"application/pdf": 524288000, "image/": 20971520}
+    download_max_bytes_by_mime: str = ""
+    download_tmp_dir: Optional[str] = None
+    extract_workers: int = 2
+    extract_timeout_seconds: float = 120.0
+    extract_max_bytes: int = 100 * 1024 * 1024
+    extract_max_pages: int = 200
+    extract_max_rows: int = 5000
+    extract_ocr: bool = True
+    extract_ocr_max_pages: int = 20
+    extract_ocr_lang: str = "eng"
+    qdrant_upsert_batch_size: int = 256
+    qdrant_upsert_parallelism: int = 4
+    qdrant_payload_mode: str = "full"
+    qdrant_hnsw_m: int = 16
+    qdrant_hnsw_ef_construct: int = 100
+    qdrant_hnsw_ef: Optional[int] = None
+    qdrant_on_disk_vectors: bool = False
+    qdrant_on_disk_payload: bool = True
+    qdrant_quantization: str = "none"
+    qdrant_quantization_always_ram: bool = True
+    qdrant_quantization_oversampling: float = 2.0
 
     class Config:
         env_file = ".env"
 
+    @field_validator("download_max_bytes_by_mime")
+    @classmethod
+    def _check_download_limits(cls, value: str) -> str:
+        try:
+            limits = json.loads(value or "{}")
+        except ValueError as e:
+            raise ValueError(f"not valid JSON: {e}") from e
+        if not isinstance(limits, dict):
+            raise ValueError("must be a JSON object of MIME type or prefix -> bytes")
+        for mime, limit in limits.items():
+            if not isinstance(limit, int) or isinstance(limit, bool) or limit <= 0:
+                raise ValueError(f"limit for {mime!r} must be a positive integer, got {limit!r}")
+        return value
+
+    @cached_property
+    def download_limits(self) -> Dict[str, int]:
+        # DOWNLOAD_MAX_BYTES_BY_MIME, parsed once; validated when the settings are loaded
+        return json.loads(self.download_max_bytes_by_mime or "{}")
+
 
 settings = Settings()
@@ -0,0 +1,250 @@
+import asyncio
+import re
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional, Set, Tuple
+
+import numpy as np
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_query(text: str) -> str:
+    return _WS.sub(" ", text).strip().lower().rstrip("?!. ")
+
+
+def filter_key(sources: Optional[List[str]], space_key: Optional[str]) -> Tuple:
+    return tuple(sorted(sources or ())), space_key
+
+
+@dataclass
+class _Entry:
+    query: str
+    fkey: Tuple
+    vector: Optional[np.ndarray]
+    value: Any
+    cited: Set[Tuple[str, str]]
+    created: float = field(default_factory=time.monotonic)
+
+
+class AnswerCache:
+    # exact tier: normalized query + filter -> entry; semantic tier: nearest cached query embedding under the same
+    # filter. Entries are dropped by TTL, LRU size bound, or when ingestion touches a (source, doc_id) they cite.
+    # Ingestion in another process only shows up as a new shared generation (read on every lookup and put): the
+    # cache cannot tell which documents changed there, so it drops everything.
+    def __init__(
+        self,
+        max_entries: int,
+        ttl_seconds: float,
+        similarity: float,
+        generation: Optional[Callable[[], int]] = None,
+    ):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self.similarity = similarity
+        self._generation = generation
+        self._lock = threading.Lock()
+        self._shared = generation() if generation else 0
+        self._local = 0
+        self._seq = 0
+        self._entries: "OrderedDict[int, _Entry]" = OrderedDict()
+        self._exact: Dict[Tuple, int] = {}
+        self._by_doc: Dict[Tuple[str, str], Set[int]] = {}
+        self._matrices: Dict[Tuple, Tuple[List[int], np.ndarray]] = {}
+        self.exact_hits = self.semantic_hits = self.misses = 0
+        self.evictions = self.invalidations = self.stale_puts = 0
+
+    def _drop(self, eid: int):
+        e = self._entries.pop(eid, None)
+        if e is None:
+            return
+        if self._exact.get((e.query, e.fkey)) == eid:
+            del self._exact[(e.query, e.fkey)]
+        for doc in e.cited:
+            ids = self._by_doc.get(doc)
+            if ids:
+                ids.discard(eid)
+                if not ids:
+                    del self._by_doc[doc]
+        self._matrices.pop(e.fkey, None)
+
+    def _sync(self) -> Tuple[int, int]:
+        # caller holds the lock
+        if self._generation is not None:
+            shared = self._generation()
+            if shared != self._shared:
+                self.invalidations += len(self._entries)
+                self._entries.clear()
+                self._exact.clear()
+                self._by_doc.clear()
+                self._matrices.clear()
+                self._shared = shared
+        return self._local, self._shared
+
+    def _live(self, eid: int) -> Optional[_Entry]:
+        e = self._entries.get(eid)
+        if e is None:
+            return None
+        if time.monotonic() - e.created > self.ttl:
+            self._drop(eid)
+            self.evictions += 1
+            return None
+        self._entries.move_to_end(eid)
+        return e
+
+    def _matrix(self, fkey: Tuple) -> Tuple[List[int], Optional[np.ndarray]]:
+        if fkey not in self._matrices:
+            ids = [eid for eid, e in self._entries.items() if e.fkey == fkey and e.vector is not None]
+            mat = np.stack([self._entries[eid].vector for eid in ids]) if ids else None
+            self._matrices[fkey] = (ids, mat)
+        return self._matrices[fkey]
+
+    def get_exact(self, query: str, fkey: Tuple):
+        with self._lock:
+            self._sync()
+            eid = self._exact.get((normalize_query(query), fkey))
+            e = self._live(eid) if eid is not None else None
+            if e is None:
+                return None
+            self.exact_hits += 1
+            return e.value
+
+    def get_similar(self, vector: List[float], fkey: Tuple):
+        v = np.asarray(vector, dtype=np.float32)
+        v /= np.linalg.norm(v) or 1.0
+        with self._lock:
+            self._sync()
+            ids, mat = self._matrix(fkey)
+            if mat is not None:
+                scores = mat @ v
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity:
+                    e = self._live(ids[best])
+                    if e is not None:
+                        self.semantic_hits += 1
+                        return e.value
+            self.misses += 1
+            return None
+
+    def token(self) -> Tuple[int, int]:
+        # taken before retrieval and handed to put(): an answer built while the index changed is not cached
+        with self._lock:
+            return self._sync()
+
+    def put(
+        self,
+        query: str,
+        fkey: Tuple,
+        vector: Optional[List[float]],
+        value,
+        cited: Iterable[Tuple[str, str]],
+        token: Optional[Tuple[int, int]] = None,
+    ):
+        vec = None
+        if vector is not None:
+            vec = np.asarray(vector, dtype=np.float32)
+            vec /= np.linalg.norm(vec) or 1.0
+        with self._lock:
+            if token is not None and self._sync() != token:
+                self.stale_puts += 1
+                return
+            self._seq += 1
+            e = _Entry(normalize_query(query), fkey, vec, value, set(cited))
+            old = self._exact.get((e.query, fkey))
+            if old is not None:
+                self._drop(old)
+            self._entries[self._seq] = e
+            self._exact[(e.query, fkey)] = self._seq
+            for doc in e.cited:
+                self._by_doc.setdefault(doc, set()).add(self._seq)
+            self._matrices.pop(fkey, None)
+            while len(self._entries) > self.max_entries:
+                self._drop(next(iter(self._entries)))
+                self.evictions += 1
+
+    def invalidate(self, source: str, doc_ids: Iterable[str], generation: Optional[int] = None):
+        # called from ingestion threads whenever points of these documents are written or deleted
+        with self._lock:
+            self._local += 1
+            for doc_id in doc_ids:
+                for eid in list(self._by_doc.get((source, doc_id), ())):
+                    self._drop(eid)
+                    self.invalidations += 1
+            # the change that produced this generation is the one just applied; adopt it unless another
+            # process moved the generation in between, which _sync() then handles by dropping everything
+            if generation is not None and generation == self._shared + 1:
+                self._shared = generation
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.exact_hits + self.semantic_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "exact_hits": self.exact_hits,
+            "semantic_hits": self.semantic_hits,
+            "misses": self.misses,
+            "hit_rate": round((self.exact_hits + self.semantic_hits) / lookups, 4) if lookups else 0.0,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+            "stale_puts": self.stale_puts,
+        }
+
+
+class LRUCache:
+    def __init__(self, max_size: int, ttl_seconds: float):
+        self.max_size = max_size
+        self.ttl = ttl_seconds
+        self._data: "OrderedDict[Hashable, Tuple[float, Any]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+
+    def get(self, key: Hashable):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None or time.monotonic() - item[0] > self.ttl:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def set(self, key: Hashable, value):
+        with self._lock:
+            self._data[key] = (time.monotonic(), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+class SingleFlight:
+    # concurrent callers with the same key share one in-flight call instead of each going upstream
+    def __init__(self):
+        self._inflight: Dict[Hashable, asyncio.Task] = {}
+        self.calls = self.coalesced = 0
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[Any]]):
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.calls += 1
+            task = asyncio.get_running_loop().create_task(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: one caller disconnecting must not cancel the call the others are waiting on
+        return await asyncio.shield(task)
+
+    def stats(self) -> Dict[str, Any]:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self._inflight)}
@@ -0,0 +1,111 @@
+import re
+from typing import Any, Dict, List, NamedTuple, Optional, Tuple
+
+from chat.ingest.chunking import TokenCounter
+
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+# chunks written before chunk_start was stored: look for the overlap in at most this many characters
+_MAX_TEXT_OVERLAP = 2000
+
+
+class Span(NamedTuple):
+    start: Optional[int]
+    text: str
+    score: float
+
+
+def _score(point) -> float:
+    return point.score if point.score is not None else 0.0
+
+
+def _text_overlap(head: str, tail: str) -> int:
+    # length of the longest suffix of head that is a prefix of tail
+    for n in range(min(len(head), len(tail), _MAX_TEXT_OVERLAP), 0, -1):
+        if head.endswith(tail[:n]):
+            return n
+    return 0
+
+
+def merge_spans(points: List[Any]) -> List[Span]:
+    # points of one document -> contiguous spans in document order; overlapping or touching chunks become one span
+    def position(p):
+        pl = p.payload or {}
+        return pl.get("chunk_start", -1), pl.get("chunk_index", -1)
+
+    spans: List[Span] = []
+    prev_index = None
+    for p in sorted(points, key=position):
+        pl = p.payload or {}
+        text, start, index = pl.get("text", ""), pl.get("chunk_start"), pl.get("chunk_index")
+        if spans:
+            last = spans[-1]
+            if start is not None and last.start is not None:
+                end = last.start + len(last.text)
+                if start <= end and last.text[start - last.start :] == text[: end - start]:
+                    spans[-1] = Span(last.start, last.text + text[end - start :], max(last.score, _score(p)))
+                    prev_index = index
+                    continue
+            elif index is not None and prev_index is not None and index == prev_index + 1:
+                overlap = _text_overlap(last.text, text)
+                spans[-1] = Span(last.start, last.text + text[overlap:], max(last.score, _score(p)))
+                prev_index = index
+                continue
+            elif text and text in last.text:
+                continue
+        spans.append(Span(start, text, _score(p)))
+        prev_index = index
+    return spans
+
+
+class ContextBuilder:
+    # Groups retrieved chunks by document, merges overlapping/adjacent chunks into spans and fills a token budget
+    # with the best-scoring spans. Each document gets one header; its spans keep document order.
+    def __init__(self, max_tokens: int, counter: Optional[TokenCounter] = None):
+        self.max_tokens = max_tokens
+        self.counter = counter or TokenCounter()
+
+    def _truncate(self, text: str, budget: int) -> str:
+        # cut at a sentence boundary rather than mid-word
+        out = ""
+        for sentence in _SENTENCE_END.split(text):
+            candidate = f"{out} {sentence}" if out else sentence
+            if self.counter.count(candidate) > budget:
+                break
+            out = candidate
+        return out
+
+    def build(self, points: List[Any]) -> str:
+        docs: Dict[Tuple[str, str], List[Any]] = {}
+        for p in points:
+            pl = p.payload or {}
+            docs.setdefault((pl.get("source", ""), pl.get("doc_id") or pl.get("url", "")), []).append(p)
+
+        headers, candidates = {}, []
+        for key, doc_points in docs.items():
+            pl = doc_points[0].payload or {}
+            headers[key] = f"[{pl.get('title', 'Untitled')}] ({pl.get('source', '')})\nURL: {pl.get('url', '')}\n---\n"
+            for order, span in enumerate(merge_spans(doc_points)):
+                candidates.append((span.score, key, order, span.text))
+
+        chosen: Dict[Tuple[str, str], List[Tuple[int, str]]] = {}
+        best: Dict[Tuple[str, str], float] = {}
+        used = 0
+        for score, key, order, text in sorted(candidates, key=lambda c: c[0], reverse=True):
+            cost = self.counter.count(text) + (0 if key in chosen else self.counter.count(headers[key]))
+            if used + cost > self.max_tokens:
+                if chosen:
+                    # smaller spans further down may still fit
+                    continue
+                text = self._truncate(text, self.max_tokens - self.counter.count(headers[key]))
+                if not text:
+                    continue
+                cost = self.counter.count(text) + self.counter.count(headers[key])
+            chosen.setdefault(key, []).append((order, text))
+            best.setdefault(key, score)
+            used += cost
+
+        parts = []
+        for key in sorted(chosen, key=best.get, reverse=True):
+            spans = [text for _, text in sorted(chosen[key])]
+            parts.append(headers[key] + "\n...\n".join(s.strip("\n") for s in spans) + "\n")
+        return "\n\n".join(parts)
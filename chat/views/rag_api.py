@@ -1,17 +1,54 @@
+import asyncio
+import json
 import logging
 import time
 import uuid
-from typing import Any, Dict, List, Optional
+from typing import Any, AsyncIterator, Dict, List, Optional, Tuple
 
-import requests
-from fastapi import APIRouter, Body, Depends, status
+import httpx
+from fastapi import APIRouter, Body, status
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel, Field
-from qdrant_client import QdrantClient
-from qdrant_client.models import FieldCondition, Filter, MatchAny, MatchValue
+from qdrant_client import AsyncQdrantClient
+from qdrant_client.models import (
+    FieldCondition,
+    Filter,
+    MatchAny,
+    MatchValue,
+    NamedSparseVector,
+    QuantizationSearchParams,
+    SearchParams,
+    SparseVector,
+)
 
+from chat import metrics
+from chat.deps import OllamaDep, QdrantDep
+from chat.ingest import sparse
+from chat.ingest.qdrant_ops import index_generation, on_change
+from chat.ingest.store import TextBlobStore
 from chat.settings import settings
+from chat.views.cache import AnswerCache, LRUCache, SingleFlight, filter_key, normalize_query
+from chat.views.context import ContextBuilder
+from chat.views.rerank import Reranker
 
 logger = logging.getLogger(__name__)
+# how long a "no sparse vector in the collection" answer is trusted before asking Qdrant again
+SPARSE_RECHECK_SECONDS = 60.0
+
+
+def rrf_fuse(rankings: List[List[Any]], k: int, limit: int) -> List[Any]:
+    # reciprocal rank fusion: score(p) = sum over rankings of 1 / (k + rank); only ranks matter, not the raw scores,
+    # so cosine similarities and BM25 scores can be combined without calibration
+    scores: Dict[Any, float] = {}
+    points: Dict[Any, Any] = {}
+    for ranking in rankings:
+        for rank, p in enumerate(ranking, start=1):
+            scores[p.id] = scores.get(p.id, 0.0) + 1.0 / (k + rank)
+            points.setdefault(p.id, p)
+    fused = sorted(scores, key=scores.get, reverse=True)[:limit]
+    for pid in fused:
+        points[pid].score = scores[pid]
+    return [points[pid] for pid in fused]
 
 
 class QueryIn(BaseModel):
@@ -25,10 +62,6 @@ class QueryOut(BaseModel):
     sources: List[str] = []
 
 
-def get_qdrant() -> QdrantClient:
-    return QdrantClient(url=settings.qdrant_url)
-
-
 class RagAPI:
     def __init__(self):
         self.router = APIRouter(prefix="", tags=["RAG"])
@@ -36,15 +69,38 @@ class RagAPI:
         self.router.add_api_route(
             "/query", self.query, methods=["POST"], response_model=QueryOut, status_code=status.HTTP_200_OK
         )
+        self.router.add_api_route("/query/stream", self.query_stream, methods=["POST"])
         self.router.add_api_route("/reindex", self.reindex, methods=["POST"])
+        self.router.add_api_route("/ingest/pipeline", self.ingest_pipeline, methods=["GET"])
+        self.router.add_api_route("/ingest/status", self.ingest_status, methods=["GET"])
         self.router.add_api_route("/v1/chat/completions", self.chat_completions, methods=["POST"])
-
-    def _ollama_embeddings(self, texts: List[str]) -> List[List[float]]:
-        logger.info("_ollama_embeddings at %s/chat/embeddings for %S", settings.ollama_url, texts)
-        r = requests.post(
-            f"{settings.ollama_url}/api/embeddings", json={"model": settings.embed_model, "input": texts}, timeout=120
+        self.router.add_api_route("/cache/stats", self.cache_stats, methods=["GET"])
+        self.answers = AnswerCache(
+            settings.answer_cache_size,
+            settings.answer_cache_ttl_seconds,
+            settings.answer_cache_similarity,
+            index_generation,
+        )
+        on_change(self.answers.invalidate)
+        self.query_vectors = LRUCache(settings.query_embedding_cache_size, settings.query_embedding_cache_ttl_seconds)
+        self.embed_flight = SingleFlight()
+        self.answer_flight = SingleFlight()
+        self._sparse_checked: Optional[Tuple[float, bool]] = None
+        # MAX_CONTEXT_CHARS predates token budgeting; ~4 characters per token keeps old deployments' prompt size
+        self.context = ContextBuilder(settings.max_context_tokens or settings.max_context_chars // 4)
+        self.reranker = Reranker(
+            settings.rerank_mode,
+            settings.rerank_mmr_lambda,
+            settings.rerank_dedupe_similarity,
+            settings.rerank_model,
+            settings.rerank_budget_ms,
         )
-        r.raise_for_status()
+
+    async def _ollama_embeddings(self, ollama: httpx.AsyncClient, texts: List[str]) -> List[List[float]]:
+        logger.debug("_ollama_embeddings at %s/api/embed for %s texts", settings.ollama_url, len(texts))
+        with metrics.query_stage("embed", upstream="ollama"):
+            r = await ollama.post("/api/embed", json={"model": settings.embed_model, "input": texts})
+            r.raise_for_status()
         data = r.json()
         if "embeddings" in data:
             return data["embeddings"]
@@ -52,18 +108,154 @@ class RagAPI:
             return [data["embedding"]]
         raise RuntimeError("Unexpected Ollama embeddings response")
 
-    def _ollama_generate(self, prompt: str) -> str:
-        logger.info("_ollama_generate at %s/chat/generate for %S", settings.ollama_url, prompt)
-        r = requests.post(
-            f"{settings.ollama_url}/api/generate",
-            json={"model": settings.chat_model, "prompt": prompt, "stream": False},
-            timeout=120,
-        )
-        r.raise_for_status()
+    async def _ollama_generate(self, ollama: httpx.AsyncClient, prompt: str) -> str:
+        logger.debug("_ollama_generate at %s/api/generate, prompt of %s chars", settings.ollama_url, len(prompt))
+        with metrics.timed(
+            "rag.generate",
+            metrics.GENERATE_SECONDS.labels("blocking"),
+            metrics.UPSTREAM_ERRORS.labels("ollama", "generate"),
+        ):
+            r = await ollama.post(
+                "/api/generate",
+                json={"model": settings.chat_model, "prompt": prompt, "stream": False},
+            )
+            r.raise_for_status()
         return (r.json().get("response") or "").strip()
 
+    async def _ollama_generate_stream(self, ollama: httpx.AsyncClient, prompt: str) -> AsyncIterator[str]:
+        logger.debug("_ollama_generate_stream at %s/api/generate, prompt of %s chars", settings.ollama_url, len(prompt))
+        start, first = time.perf_counter(), True
+        with metrics.timed(
+            "rag.generate_stream",
+            metrics.GENERATE_SECONDS.labels("stream"),
+            metrics.UPSTREAM_ERRORS.labels("ollama", "generate_stream"),
+        ):
+            async with ollama.stream(
+                "POST",
+                "/api/generate",
+                json={"model": settings.chat_model, "prompt": prompt, "stream": True},
+            ) as r:
+                r.raise_for_status()
+                async for line in r.aiter_lines():
+                    if not line:
+                        continue
+                    data = json.loads(line)
+                    if data.get("response"):
+                        if first:
+                            metrics.GENERATE_TTFT_SECONDS.observe(time.perf_counter() - start)
+                            first = False
+                        yield data["response"]
+                    if data.get("done"):
+                        break
+
+    async def _lookup(self, ollama: httpx.AsyncClient, payload: QueryIn):
+        # exact match first (no embedding needed), then the semantic tier with the query embedding
+        fkey = filter_key(payload.sources, payload.space_key)
+        out = self.answers.get_exact(payload.query, fkey)
+        if out is not None:
+            metrics.CACHE_LOOKUPS.labels("answers", "exact_hit").inc()
+            return out, None
+        vec = await self._embed_query(ollama, payload.query)
+        out = self.answers.get_similar(vec, fkey)
+        metrics.CACHE_LOOKUPS.labels("answers", "semantic_hit" if out is not None else "miss").inc()
+        return out, vec
+
+    async def _embed_query(self, ollama: httpx.AsyncClient, text: str) -> List[float]:
+        vec = self.query_vectors.get(text)
+        metrics.CACHE_LOOKUPS.labels("query_embeddings", "hit" if vec is not None else "miss").inc()
+        if vec is None:
+            vec = (await self.embed_flight.do(text, lambda: self._ollama_embeddings(ollama, [text])))[0]
+            self.query_vectors.set(text, vec)
+        return vec
+
+    def _remember(self, payload: QueryIn, vec, out: QueryOut, points, generation):
+        cited = {((p.payload or {}).get("source", ""), (p.payload or {}).get("doc_id", "")) for p in points}
+        self.answers.put(payload.query, filter_key(payload.sources, payload.space_key), vec, out, cited, generation)
+
+    async def _search(self, qdrant: AsyncQdrantClient, payload: QueryIn, vec: List[float]):
+        flt = self._build_filter(payload)
+        rerank = settings.rerank_mode != "none"
+        # with a rerank stage, over-fetch and let it pick the final top_k
+        limit = max(settings.rerank_candidates, settings.top_k) if rerank else settings.top_k
+        indices, values = sparse.query_vector(payload.query)
+        if settings.hybrid_search and indices and await self._has_sparse(qdrant):
+            per_search = max(settings.hybrid_candidates, limit)
+            with metrics.query_stage("search", upstream="qdrant"):
+                dense, lexical = await asyncio.gather(
+                    self._dense_search(qdrant, vec, flt, per_search, rerank),
+                    qdrant.search(
+                        collection_name=settings.qdrant_collection,
+                        query_vector=NamedSparseVector(
+                            name=sparse.SPARSE_VECTOR, vector=SparseVector(indices=indices, values=values)
+                        ),
+                        limit=per_search,
+                        query_filter=flt,
+                        with_payload=True,
+                        with_vectors=[""] if rerank else False,
+                    ),
+                )
+            points = rrf_fuse([dense, lexical], settings.rrf_k, limit)
+        else:
+            with metrics.query_stage("search", upstream="qdrant"):
+                points = await self._dense_search(qdrant, vec, flt, limit, rerank)
+        points = await self._with_text(points)
+        if rerank:
+            with metrics.query_stage("rerank"):
+                points = await self.reranker.rerank(payload.query, points, settings.top_k)
+            for p in points:
+                p.vector = None
+        return points
+
+    async def _dense_search(
+        self, qdrant: AsyncQdrantClient, vec: List[float], flt: Optional[Filter], limit: int, with_vectors: bool
+    ):
+        return await qdrant.search(
+            collection_name=settings.qdrant_collection,
+            query_vector=vec,
+            limit=limit,
+            query_filter=flt,
+            search_params=self._search_params(),
+            with_payload=True,
+            with_vectors=with_vectors,
+        )
+
+    async def _has_sparse(self, qdrant: AsyncQdrantClient) -> bool:
+        # collections created before hybrid search have no sparse vector; search those dense-only
+        if self._sparse_checked is not None:
+            checked_at, ok = self._sparse_checked
+            if ok or time.monotonic() - checked_at < SPARSE_RECHECK_SECONDS:
+                return ok
+        try:
+            info = await qdrant.get_collection(settings.qdrant_collection)
+            ok = sparse.SPARSE_VECTOR in (info.config.params.sparse_vectors or {})
+        except Exception as e:
+            logger.warning("could not read collection %s: %s", settings.qdrant_collection, e)
+            ok = False
+        self._sparse_checked = (time.monotonic(), ok)
+        return ok
+
+    def _search_params(self) -> Optional[SearchParams]:
+        quantization = None
+        if settings.qdrant_quantization != "none":
+            # search the quantized vectors, then rescore the oversampled candidates with the originals
+            quantization = QuantizationSearchParams(
+                rescore=True, oversampling=settings.qdrant_quantization_oversampling
+            )
+        if settings.qdrant_hnsw_ef is None and quantization is None:
+            return None
+        return SearchParams(hnsw_ef=settings.qdrant_hnsw_ef, quantization=quantization)
+
+    async def _with_text(self, points):
+        # collections written with QDRANT_PAYLOAD_MODE=slim keep chunk text in the local blob store
+        missing = [p for p in points if p.payload and "text" not in p.payload and p.payload.get("chunk_hash")]
+        if missing:
+            texts = await asyncio.to_thread(TextBlobStore.open().get_many, [p.payload["chunk_hash"] for p in missing])
+            for p in missing:
+                p.payload["text"] = texts.get(p.payload["chunk_hash"], "")
+        return points
+
     def _build_filter(self, data: QueryIn) -> Optional[Filter]:
-        logger.info("build filter %s", data)
+        logger.debug("build filter %s", data)
         must = []
         if data.sources:
             must.append(FieldCondition(key="source", match=MatchAny(any=data.sources)))
@@ -72,90 +264,164 @@ class RagAPI:
         return Filter(must=must) if must else None
 
     def _build_context(self, points) -> str:
-        parts, total = [], 0
-        for p in points:
-            pl = p.payload or {}
-            chunk = f"[{pl.get('title','Untitled')}] ({pl.get('source','')})\nURL: {pl.get('url','')}\n---\n{pl.get('text','')}\n"
-            if total + len(chunk) > settings.max_context_chars:
-                chunk = chunk[: max(0, settings.max_context_chars - total)]
-            parts.append(chunk)
-            total += len(chunk)
-            if total >= settings.max_context_chars:
-                break
-        return "\n\n".join(parts)
+        with metrics.query_stage("context"):
+            return self.context.build(points)
 
-    def _answer_from_points(self, user_q: str, points) -> QueryOut:
+    def _prompt(self, user_q: str, points) -> str:
         context = self._build_context(points)
-        prompt = (
+        return (
             "You are a knowledge-base assistant. Answer using ONLY the provided context. "
             "If the answer is not in context, say you don't know. "
             "Return a concise answer and include a bullet list of source URLs at the end.\n\n"
             f"CONTEXT:\n{context}\n\nQUESTION: {user_q}\n\nANSWER:"
         )
-        answer = self._ollama_generate(prompt)
+
+    def _cites(self, points) -> List[str]:
         cites = sorted({(p.payload or {}).get("url", "") for p in points if (p.payload or {}).get("url")})
-        return QueryOut(answer=answer, sources=[c for c in cites if c])
+        return [c for c in cites if c]
+
+    async def _answer_from_points(self, ollama: httpx.AsyncClient, user_q: str, points) -> QueryOut:
+        answer = await self._ollama_generate(ollama, self._prompt(user_q, points))
+        return QueryOut(answer=answer, sources=self._cites(points))
+
+    @staticmethod
+    def _sse(data) -> str:
+        return f"data: {data if isinstance(data, str) else json.dumps(data)}\n\n"
 
     async def ping(self) -> Dict[str, Any]:
         return {"status": "ok", "time": int(time.time())}
 
-    async def query(self, payload: QueryIn, qdrant: QdrantClient = Depends(get_qdrant)) -> QueryOut:
-        vec = self._ollama_embeddings([payload.query])[0]
-        flt = self._build_filter(payload)
-        points = qdrant.search(
-            collection_name=settings.qdrant_collection,
-            query_vector=vec,
-            limit=settings.top_k,
-            query_filter=flt,
-            with_payload=True,
-        )
-        return self._answer_from_points(payload.query, points)
+    async def _answer(self, ollama: httpx.AsyncClient, qdrant: AsyncQdrantClient, payload: QueryIn) -> QueryOut:
+        key = (normalize_query(payload.query), filter_key(payload.sources, payload.space_key))
+        return await self.answer_flight.do(key, lambda: self._answer_uncoalesced(ollama, qdrant, payload))
+
+    async def _answer_uncoalesced(
+        self, ollama: httpx.AsyncClient, qdrant: AsyncQdrantClient, payload: QueryIn
+    ) -> QueryOut:
+        out, vec = await self._lookup(ollama, payload)
+        if out is not None:
+            return out
+        generation = self.answers.token()
+        points = await self._search(qdrant, payload, vec)
+        out = await self._answer_from_points(ollama, payload.query, points)
+        self._remember(payload, vec, out, points, generation)
+        return out
 
-    async def reindex(self) -> Dict[str, str]:
-        import threading
+    async def _answer_stream(self, ollama: httpx.AsyncClient, qdrant: AsyncQdrantClient, payload: QueryIn):
+        # yields answer tokens, then the final QueryOut; cache hits come back as a single token
+        out, vec = await self._lookup(ollama, payload)
+        if out is None:
+            generation = self.answers.token()
+            points = await self._search(qdrant, payload, vec)
+            pieces = []
+            async for piece in self._ollama_generate_stream(ollama, self._prompt(payload.query, points)):
+                pieces.append(piece)
+                yield piece
+            out = QueryOut(answer="".join(pieces).strip(), sources=self._cites(points))
+            self._remember(payload, vec, out, points, generation)
+        else:
+            yield out.answer
+        yield out
 
-        from chat.ingest.orchestrator import run_incremental
+    async def query(self, payload: QueryIn, qdrant: QdrantDep, ollama: OllamaDep) -> QueryOut:
+        return await self._answer(ollama, qdrant, payload)
 
-        logger.info("doing reindex")
+    async def query_stream(self, payload: QueryIn, qdrant: QdrantDep, ollama: OllamaDep) -> StreamingResponse:
+        async def events():
+            async for part in self._answer_stream(ollama, qdrant, payload):
+                if isinstance(part, QueryOut):
+                    yield self._sse({"sources": part.sources})
+                else:
+                    yield self._sse({"token": part})
+            yield self._sse("[DONE]")
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def cache_stats(self) -> Dict[str, Any]:
+        return {
+            "answers": self.answers.stats(),
+            "rerank": self.reranker.stats(),
+            "query_embeddings": self.query_vectors.stats(),
+            "coalescing": {"embed": self.embed_flight.stats(), "answer": self.answer_flight.stats()},
+        }
 
-        threading.Thread(target=run_incremental, daemon=True).start()
-        return {"status": "started"}
+    async def reindex(self, full: bool = False) -> Dict[str, Any]:
+        from chat.ingest.jobs import trigger_reindex
 
-    async def chat_completions(self, body: Dict[str, Any] = Body(...)):
-        logger.onfo("chat_completions %s", body)
-        messages = body.get("messages", [])
+        logger.info("doing reindex (full=%s)", full)
+        return await asyncio.to_thread(trigger_reindex, full)
+
+    async def ingest_status(self) -> Dict[str, Any]:
+        from chat.ingest.jobs import job_status
+
+        return await asyncio.to_thread(job_status)
+
+    async def ingest_pipeline(self) -> Dict[str, Any]:
+        from chat.ingest.pipeline import pipeline_stats
+
+        return pipeline_stats()
+
+    def _chat_query(self, messages: List[Dict[str, Any]]) -> Optional[QueryIn]:
         user_q = ""
         for m in reversed(messages):
             if m.get("role") == "user":
                 user_q = m.get("content", "")
                 break
         if not user_q:
-            return {"error": "no user message found"}
+            return None
         sources = None
         for m in messages:
             if m.get("role") in ("system", "user"):
                 content = m.get("content", "")
                 if "sources" in content and "{" in content and "}" in content:
                     try:
-                        import json
-
                         j = json.loads(content[content.find("{") : content.rfind("}") + 1])
                         if isinstance(j.get("sources"), list):
                             sources = j["sources"]
                     except Exception:
                         pass
-        payload = QueryIn(query=user_q, sources=sources)
-        vec = self._ollama_embeddings([payload.query])[0]
-        flt = self._build_filter(payload)
-        qdrant = get_qdrant()
-        points = qdrant.search(
-            collection_name=settings.qdrant_collection,
-            query_vector=vec,
-            limit=settings.top_k,
-            query_filter=flt,
-            with_payload=True,
-        )
-        out = self._answer_from_points(payload.query, points)
+        return QueryIn(query=user_q, sources=sources)
+
+    @staticmethod
+    def _sources_footer(sources: List[str]) -> str:
+        return "\n\nSources:\n" + "\n".join(f"- {u}" for u in sources) if sources else ""
+
+    def _chat_stream(self, ollama: httpx.AsyncClient, qdrant: AsyncQdrantClient, payload: QueryIn) -> StreamingResponse:
+        cid, now = f"chatcmpl-{uuid.uuid4().hex}", int(time.time())
+
+        def chunk(delta, finish_reason=None):
+            return self._sse(
+                {
+                    "id": cid,
+                    "object": "chat.completion.chunk",
+                    "created": now,
+                    "model": settings.chat_model,
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }
+            )
+
+        async def events():
+            yield chunk({"role": "assistant", "content": ""})
+            async for part in self._answer_stream(ollama, qdrant, payload):
+                if isinstance(part, QueryOut):
+                    footer = self._sources_footer(part.sources)
+                    if footer:
+                        yield chunk({"content": footer})
+                else:
+                    yield chunk({"content": part})
+            yield chunk({}, "stop")
+            yield self._sse("[DONE]")
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    async def chat_completions(self, qdrant: QdrantDep, ollama: OllamaDep, body: Dict[str, Any] = Body(...)):
+        logger.debug("chat_completions with %s messages", len(body.get("messages", [])))
+        payload = self._chat_query(body.get("messages", []))
+        if payload is None:
+            return {"error": "no user message found"}
+        if body.get("stream"):
+            return self._chat_stream(ollama, qdrant, payload)
+        out = await self._answer(ollama, qdrant, payload)
         now = int(time.time())
         return {
             "id": f"chatcmpl-{uuid.uuid4().hex}",
@@ -167,8 +433,7 @@ class RagAPI:
                     "index": 0,
                     "message": {
                         "role": "assistant",
-                        "content": out.answer
-                        + ("\n\nSources:\n" + "\n".join(f"- {u}" for u in out.sources) if out.sources else ""),
+                        "content": out.answer + self._sources_footer(out.sources),
                     },
                     "finish_reason": "stop",
                 }
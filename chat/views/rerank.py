@@ -0,0 +1,136 @@
+import asyncio
+import logging
+import threading
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:  # optional; without it the reranker falls back to MMR
+    CrossEncoder = None
+
+logger = logging.getLogger(__name__)
+
+
+def dense_vector(point) -> Optional[List[float]]:
+    # collections with a sparse vector return {"": dense, "bm25": sparse}; older ones return the dense list
+    vec = point.vector
+    if isinstance(vec, dict):
+        vec = vec.get("")
+    return vec if isinstance(vec, list) else None
+
+
+def _unit_rows(vectors: Sequence[List[float]]) -> np.ndarray:
+    mat = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(mat, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return mat / norms
+
+
+class Reranker:
+    # Reorders an over-fetched candidate list and keeps the best few. Candidates come from Qdrant with vectors;
+    # near-duplicate chunks of the same document are dropped first, then either a cross-encoder (when installed
+    # and it answers within the budget) or MMR over the returned vectors picks the final chunks.
+    def __init__(self, mode: str, mmr_lambda: float, dedupe_similarity: float, model: str, budget_ms: float):
+        self.mode = mode
+        self.mmr_lambda = mmr_lambda
+        self.dedupe_similarity = dedupe_similarity
+        self.budget = budget_ms / 1000.0
+        self._model = None
+        # one prediction at a time: a timed-out one keeps running in its thread until it finishes
+        self._busy = threading.Lock()
+        self.cross_encoder_runs = self.timeouts = self.fallbacks = self.busy_skips = 0
+        if mode == "cross-encoder":
+            if CrossEncoder is None:
+                logger.warning("RERANK_MODE=cross-encoder but sentence-transformers is not installed; using MMR")
+            else:
+                # loading takes seconds; queries use MMR until the model is ready
+                threading.Thread(target=self._load, args=(model,), name="rerank-load", daemon=True).start()
+
+    def _load(self, model: str):
+        try:
+            self._model = CrossEncoder(model, device="cpu")
+            logger.info("rerank model %s loaded", model)
+        except Exception as e:
+            logger.exception("could not load rerank model %s: %s", model, e)
+
+    def dedupe(self, points: List[Any]) -> List[Any]:
+        # points are in rank order, so the first of a near-identical pair from the same document wins
+        kept = []
+        for p in points:
+            pl = p.payload or {}
+            vec = dense_vector(p)
+            unit = _unit_rows([vec])[0] if vec is not None else None
+            if not any(self._same_chunk(pl, unit, q_pl, q_unit) for q_pl, q_unit, _ in kept):
+                kept.append((pl, unit, p))
+        return [p for _, _, p in kept]
+
+    def _same_chunk(self, a, a_unit, b, b_unit) -> bool:
+        if (a.get("source"), a.get("doc_id")) != (b.get("source"), b.get("doc_id")):
+            return False
+        if a.get("chunk_hash") == b.get("chunk_hash"):
+            return True
+        return a_unit is not None and b_unit is not None and float(a_unit @ b_unit) >= self.dedupe_similarity
+
+    def mmr(self, points: List[Any], limit: int) -> List[Any]:
+        if not points or any(dense_vector(p) is None for p in points):
+            # nothing to diversify on; keep the retrieval order
+            return points[:limit]
+        docs = _unit_rows([dense_vector(p) for p in points])
+        # relevance is the retrieval rank (RRF-fused in hybrid mode), scaled to 1..0 to compare with cosine
+        # redundancy; recomputing it from the dense vectors would ignore what the sparse search found
+        relevance = 1.0 - np.arange(len(points), dtype=np.float32) / len(points)
+        selected: List[int] = []
+        max_sim = np.full(len(points), -np.inf, dtype=np.float32)
+        candidates = set(range(len(points)))
+        while candidates and len(selected) < limit:
+            redundancy = max_sim if selected else np.zeros_like(max_sim)
+            score = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+            best = max(candidates, key=score.__getitem__)
+            selected.append(best)
+            candidates.discard(best)
+            max_sim = np.maximum(max_sim, docs @ docs[best])
+        return [points[i] for i in selected]
+
+    async def _cross_encode(self, query: str, points: List[Any], limit: int) -> Optional[List[Any]]:
+        if not self._busy.acquire(blocking=False):
+            self.busy_skips += 1
+            return None
+        pairs = [(query, (p.payload or {}).get("text", "")) for p in points]
+
+        def predict():
+            try:
+                return self._model.predict(pairs)
+            finally:
+                self._busy.release()
+
+        try:
+            scores = await asyncio.wait_for(asyncio.to_thread(predict), timeout=self.budget)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            logger.warning("cross-encoder exceeded %.0f ms for %s candidates", self.budget * 1000, len(points))
+            return None
+        self.cross_encoder_runs += 1
+        order = np.argsort(-np.asarray(scores))[:limit]
+        return [points[i] for i in order]
+
+    async def rerank(self, query: str, points: List[Any], limit: int) -> List[Any]:
+        points = self.dedupe(points)
+        if self.mode == "cross-encoder" and self._model is not None:
+            out = await self._cross_encode(query, points, limit)
+            if out is not None:
+                return out
+        if self.mode == "cross-encoder":
+            self.fallbacks += 1
+        return self.mmr(points, limit)
+
+    def stats(self):
+        return {
+            "mode": self.mode,
+            "model_loaded": self._model is not None,
+            "cross_encoder_runs": self.cross_encoder_runs,
+            "timeouts": self.timeouts,
+            "fallbacks": self.fallbacks,
+            "busy_skips": self.busy_skips,
+        }
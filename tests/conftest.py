@@ -0,0 +1,6 @@
+import os
+import tempfile
+
+# chat modules read these at import time: keep the tests off the real Qdrant and /app_state
+os.environ.setdefault("QDRANT_URL", ":memory:")
+os.environ.setdefault("STATE_PATH", os.path.join(tempfile.mkdtemp(prefix="chat-tests-"), "state.json"))
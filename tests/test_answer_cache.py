@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+
+from chat.views.rag_api import QueryIn, QueryOut, RagAPI
+
+POINTS = [SimpleNamespace(payload={"source": "gdrive", "doc_id": "d1", "url": "https://x/d1", "text": "body"})]
+
+
+def _api(pieces):
+    api = RagAPI()
+
+    async def lookup(ollama, payload):
+        return None, [1.0, 0.0]
+
+    async def search(qdrant, payload, vec):
+        return POINTS
+
+    async def generate(ollama, prompt):
+        for piece in pieces:
+            yield piece
+
+    api._lookup, api._search, api._ollama_generate_stream = lookup, search, generate
+    api._prompt = lambda query, points: query
+    return api
+
+
+async def _drain(api, query):
+    return [part async for part in api._answer_stream(None, None, QueryIn(query=query))]
+
+
+def test_streamed_answer_is_cached():
+    api = _api(["The ", "answer", "."])
+    parts = asyncio.run(_drain(api, "what is it?"))
+    assert parts[:-1] == ["The ", "answer", "."]
+    assert isinstance(parts[-1], QueryOut) and parts[-1].answer == "The answer."
+    assert api.answers.get_exact("what is it?", (tuple(), None)).answer == "The answer."
+    assert api.answers.stats()["stale_puts"] == 0
+
+
+def test_streamed_answer_not_cached_when_index_changes_meanwhile():
+    api = _api(["old"])
+    inner = api._search
+
+    async def search(qdrant, payload, vec):
+        api.answers.invalidate("gdrive", ["d1"])
+        return await inner(qdrant, payload, vec)
+
+    api._search = search
+    asyncio.run(_drain(api, "what is it?"))
+    assert api.answers.get_exact("what is it?", (tuple(), None)) is None
+    assert api.answers.stats()["stale_puts"] == 1